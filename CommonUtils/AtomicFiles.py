@@ -0,0 +1,149 @@
+import os
+import json
+import uuid
+import hashlib
+import shutil
+
+# Every output is written to a temporary file next to it and renamed over the
+# final name only once it is complete, so readers never see a truncated file
+# and concurrent runs can not interleave their rows. The manifest sidecar is
+# written last and records the row count and checksum of the committed file:
+# a data file with a fresh manifest is known to be complete without rescanning it.
+
+
+# Unique per process and writer, hidden, and never matched by list_state_files
+def temporary_file_name(path):
+    directory, name = os.path.split(str(path))
+    return os.path.join(directory, '.' + name + '.' + str(os.getpid()) + '-' + uuid.uuid4().hex[:8] + '.tmp')
+
+
+class AtomicFile:
+    """
+    Binary file that only appears under its name once it is committed.
+
+    Bytes are written to a temporary file in the same directory (so the final
+    os.replace is atomic) and hashed on the way. close commits the file,
+    abort (or leaving a with block on an exception) removes the temporary file
+    and leaves any previous version of the file untouched. In append mode the
+    previous version is copied into the temporary file first.
+    """
+
+    def __init__(self, path, append=False):
+        self.path = str(path)
+        self.tmp_name = temporary_file_name(self.path)
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self.file = open(self.tmp_name, 'wb')
+        if append and os.path.exists(self.path):
+            with open(self.path, 'rb') as previous:
+                for chunk in iter(lambda: previous.read(1 << 20), b''):
+                    self.write(chunk)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    @property
+    def closed(self):
+        return self.file.closed
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def checksum(self):
+        return self.hash.hexdigest()
+
+    # Make the data durable, then move it under its final name
+    def close(self):
+        if self.file.closed:
+            return
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.tmp_name, self.path)
+
+    def abort(self):
+        if not self.file.closed:
+            self.file.close()
+        if os.path.exists(self.tmp_name):
+            os.remove(self.tmp_name)
+
+
+# Write a small text sidecar atomically
+def write_text_atomically(path, text):
+    with AtomicFile(path) as fl:
+        fl.write(text.encode())
+
+
+# Copy src to dst atomically
+def copy_atomically(src, dst):
+    with AtomicFile(dst) as fl, open(src, 'rb') as source:
+        shutil.copyfileobj(source, fl)
+
+
+# The manifest sidecar lives next to the data file
+def manifest_file_name(data_file):
+    return str(data_file) + '.manifest.json'
+
+
+# Name, size and modification time of a file, enough to notice that it changed
+def file_stamp(path):
+    stat = os.stat(path)
+    return {'name': os.path.basename(str(path)), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def write_manifest(data_file, rows, checksum, **fields):
+    """
+    Parameters
+    ----------
+    data_file : str ,
+        The committed data file.
+    rows : int ,
+        The number of data rows (without the header).
+    checksum : str ,
+        sha256 of the bytes of the file as stored on disk.
+    fields :
+        Anything else worth recording, e.g. the source file and the parameters
+        it was produced with, so a resumed run can tell whether it is up to date.
+    """
+    manifest = dict(file_stamp(data_file), rows=int(rows), sha256=checksum)
+    manifest.update(fields)
+    write_text_atomically(manifest_file_name(data_file), json.dumps(manifest, indent=2))
+
+
+# Read the manifest of data_file, returns None if it is missing or stale
+def read_manifest(data_file):
+    name = manifest_file_name(data_file)
+    if not os.path.exists(name) or not os.path.exists(data_file):
+        return None
+    with open(name) as fl:
+        try:
+            manifest = json.load(fl)
+        except ValueError:
+            return None
+    stamp = file_stamp(data_file)
+    if manifest.get('size') != stamp['size'] or manifest.get('mtime_ns') != stamp['mtime_ns']:
+        return None
+    return manifest
+
+
+# Rehash data_file and compare it with its manifest
+def verify_manifest(data_file):
+    manifest = read_manifest(data_file)
+    if manifest is None:
+        return False
+    digest = hashlib.sha256()
+    with open(data_file, 'rb') as fl:
+        for chunk in iter(lambda: fl.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest() == manifest['sha256']
@@ -0,0 +1,218 @@
+import io
+import os
+import gzip
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from CommonUtils.AtomicFiles import AtomicFile
+
+# Supported compressions and the extension they add to the file name
+COMPRESSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('zstd compression needs the zstandard package: pip install zstandard')
+    return zstandard
+
+
+# The compression of a file, judged by its extension
+def compression_of(path):
+    for compress, extension in COMPRESSIONS.items():
+        if str(path).endswith(extension):
+            return compress
+    return None
+
+
+def with_compression_extension(name, compress):
+    if compress is None:
+        return name
+    if compress not in COMPRESSIONS:
+        raise ValueError('compression has to be one of: ' + ", ".join(COMPRESSIONS))
+    return name + COMPRESSIONS[compress]
+
+
+def strip_compression_extension(name):
+    compress = compression_of(name)
+    if compress is None:
+        return name
+    return name[:-len(COMPRESSIONS[compress])]
+
+
+# Open a (possibly compressed) file for reading its uncompressed bytes
+def open_binary(path):
+    compress = compression_of(path)
+    if compress == 'gzip':
+        return gzip.open(path, 'rb')
+    if compress == 'zstd':
+        reader = _zstandard().ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True)
+        return io.BufferedReader(reader)
+    return open(path, 'rb')
+
+
+# Open a (possibly compressed) file as text, ready for csv.reader
+def open_text(path):
+    if compression_of(path) is None:
+        return open(path, mode='r', newline='')
+    return io.TextIOWrapper(open_binary(path), newline='')
+
+
+# Move forward to offset, decompressing and discarding when the stream cannot seek
+def skip_to(fl, position, offset):
+    if offset < position:
+        raise ValueError('cannot seek backwards from ' + str(position) + ' to ' + str(offset))
+    if fl.seekable():
+        fl.seek(offset)
+        return offset
+    remaining = offset - position
+    while remaining > 0:
+        chunk = fl.read(min(remaining, 1 << 20))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+    return offset - remaining
+
+
+def uncompressed_size(path):
+    if compression_of(path) is None:
+        return os.path.getsize(path)
+    return _scan(path)[0]
+
+
+# Uncompressed size and number of lines of a file
+def _scan(path):
+    size = 0
+    lines = 0
+    with open_binary(path) as fl:
+        for chunk in iter(lambda: fl.read(1 << 20), b''):
+            size += len(chunk)
+            lines += chunk.count(b'\n')
+    return size, lines
+
+
+def _compress_block(block, compress, level):
+    if compress == 'gzip':
+        return gzip.compress(block, compresslevel=level if level is not None else 6)
+    return _zstandard().ZstdCompressor(level=level if level is not None else 3).compress(block)
+
+
+class StateFileWriter:
+    """
+    Streaming writer for (optionally compressed) state files.
+
+    Text is collected into blocks, every block is compressed on a thread pool
+    (zlib and zstd release the GIL) into an independent gzip member or zstd
+    frame, and the compressed blocks are written in order. Concatenated members
+    and frames are valid gzip/zstd files, so appending to an existing file works
+    the same way. tell() returns the offset in the uncompressed stream, which is
+    what the trajectory index records. Writers of many files can share one
+    executor, which is then left running on close.
+
+    By default the file is atomic (see AtomicFiles): it is written under a
+    temporary name and only replaces path on close, abort discards it.
+    lines and checksum() are what the manifest sidecar records.
+    """
+
+    def __init__(self, path, compress=None, threads=None, append=False, block_size=1 << 22, level=None, executor=None, atomic=True):
+        if compress is not None and compress not in COMPRESSIONS:
+            raise ValueError('compression has to be one of: ' + ", ".join(COMPRESSIONS))
+        if compress == 'zstd':
+            _zstandard()
+        self.path = path
+        self.compress = compress
+        self.level = level
+        self.block_size = block_size
+        self.threads = threads if threads else (os.cpu_count() or 1)
+        self.offset = 0
+        self.lines = 0
+        if append and os.path.exists(path):
+            self.offset, self.lines = _scan(path)
+        self.atomic = atomic
+        if atomic:
+            self.file = AtomicFile(path, append=append)
+        else:
+            self.file = open(path, 'ab' if append else 'wb')
+        self.own_executor = executor is None and compress is not None
+        self.executor = executor
+        if self.own_executor:
+            self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        if compress is None:
+            self.executor = None
+        self.pending = deque()
+        self.buffer = []
+        self.buffered = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.offset += len(data)
+        self.lines += data.count(b'\n')
+        if self.buffered >= self.block_size:
+            self._submit()
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    # sha256 of the stored (compressed) bytes, only known for atomic files
+    def checksum(self):
+        if not self.atomic:
+            return None
+        return self.file.checksum()
+
+    def _submit(self):
+        if self.buffered == 0:
+            return
+        block = b''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        if self.executor is None:
+            self.file.write(block)
+            return
+        self.pending.append(self.executor.submit(_compress_block, block, self.compress, self.level))
+        # Bound the number of blocks held in memory
+        while len(self.pending) > 2 * self.threads:
+            self.file.write(self.pending.popleft().result())
+
+    def flush(self):
+        self._submit()
+        while self.pending:
+            self.file.write(self.pending.popleft().result())
+        self.file.flush()
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.flush()
+        if self.own_executor:
+            self.executor.shutdown()
+        self.file.close()
+
+    # Drop everything written, a previous version of the file stays as it was
+    def abort(self):
+        if self.file.closed:
+            return
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.buffer = []
+        if self.own_executor:
+            self.executor.shutdown()
+        if self.atomic:
+            self.file.abort()
+        else:
+            self.file.close()
@@ -0,0 +1,80 @@
+import numpy as np
+
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Contact geometry between the pusher tip and the corners of the object,
+# shared by the flagger (DistanceFilter) and the contact filter of the processor.
+
+# Default distance under which the tip is considered to be in contact
+CONTACT_THRESHOLD = 0.05
+
+
+def get_closest_points(np_nodes, np_tip):
+    # Find two closest points
+    np_tip = np_tip[:, :2]
+    np_nodes = np_nodes[:, :8]
+
+    # Closeness
+    np_tip = np.tile(np_tip,(1,4))
+    diff = np_nodes - np_tip
+    diff = diff.reshape((len(diff), 4, 2))
+    pow2s = np.power(diff, 2)
+
+    # No sqrt because we don't care about actual values, we just want to compare them
+    sums = np.sum(pow2s, axis=2)
+    idx = np.argpartition(sums, 2, axis=1)
+
+    bools = np.zeros(idx.shape)
+    bools[:,:2] = 1
+
+    # Boolean indexing
+    closest_nodes = np_nodes.reshape((len(np_nodes), 4, 2))
+    bools = np.reshape(bools, (len(bools), closest_nodes.shape[1], 1))
+    bools = np.repeat(bools, 2, axis=2)
+    bools = bools > 0
+
+    closest_nodes = closest_nodes[bools]
+    closest_nodes = closest_nodes.reshape((len(bools), 2, 2))
+
+    return closest_nodes
+
+def calculate_distance(closest_np, np_tip):
+    n_not_unit = closest_np[:, 0, :] - closest_np[:, 1, :]
+    l = np.linalg.norm(n_not_unit, axis=1, keepdims=True)
+    n = n_not_unit / l
+
+    p = np_tip[:, :2]
+
+    a = closest_np[:, 0]
+
+    b = (a - p) - ((a - p) * n) * n
+
+    distance = np.linalg.norm(b, axis=1)
+
+    return distance
+
+
+# Distance of the tip from the object side given by its closest corners, for every state
+def contact_distance(np_nodes, np_tip):
+    return calculate_distance(get_closest_points(np_nodes, np_tip), np_tip)
+
+
+def contact_windows(in_contact, number_of_steps, min_contact_steps):
+    """
+    Parameters
+    ----------
+    in_contact : np.array ,
+        Boolean contact flag of every state of an unbroken trajectory.
+    number_of_steps : int ,
+        The number of consecutive states in an example.
+    min_contact_steps : int ,
+        How many states of an example have to be in contact.
+
+    Returns
+    -------
+    A boolean mask over the examples (windows) of the trajectory, True for the ones in contact.
+    """
+    if len(in_contact) < number_of_steps:
+        return np.zeros(0, dtype=bool)
+    steps = sliding_window_view(in_contact.astype(np.int64), number_of_steps).sum(axis=1)
+    return steps >= min_contact_steps
@@ -0,0 +1,164 @@
+import os
+import re
+import numpy as np
+
+from CommonUtils.CompressedFiles import open_binary, skip_to
+from CommonUtils.AtomicFiles import temporary_file_name
+from CommonUtils.TrajectoryIndex import read_header
+
+# Row k of every part file _1_of_n ... _n_of_n holds a state of the example
+# with id k. The id index sidecar (<file>.ids.npz) maps every id of a part
+# file to the byte offset of its row, sorted by id, so a batch of examples is
+# read with one seek per row and part file, whether the file is shuffled or not.
+
+PART_PATTERN = re.compile(r'_(\d+)_of_(\d+)(?=[_.])')
+
+
+def ids_file_name(data_file):
+    return str(data_file) + '.ids.npz'
+
+
+def _stamp(data_file):
+    stat = os.stat(data_file)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+# The part files of the example group data_file belongs to, in part order
+def part_file_names(data_file):
+    directory, name = os.path.split(str(data_file))
+    matches = list(PART_PATTERN.finditer(name))
+    if not matches:
+        raise ValueError('not a part file (_k_of_n): ' + str(data_file))
+    match = matches[-1]
+    number_of_parts = int(match.group(2))
+    return [os.path.join(directory, name[:match.start()] + '_' + str(part) + '_of_' + str(number_of_parts) + name[match.end():])
+            for part in range(1, number_of_parts + 1)]
+
+
+def build_id_index(data_file):
+    """
+    Scans data_file once.
+
+    Returns
+    -------
+    ids, offsets : np.array ,
+        int64 example ids in increasing order and the offsets of their rows
+        (in the uncompressed stream).
+    """
+    ids = []
+    offsets = []
+    with open_binary(data_file) as fl:
+        offset = len(fl.readline())
+        for line in iter(fl.readline, b''):
+            try:
+                ids.append(int(float(line.split(b',', 1)[0])))
+                offsets.append(offset)
+            except ValueError:
+                pass
+            offset += len(line)
+    ids = np.array(ids, dtype=np.int64)
+    offsets = np.array(offsets, dtype=np.int64)
+    order = np.argsort(ids, kind='stable')
+    return ids[order], offsets[order]
+
+
+# Read the id index of data_file, built and saved when it is missing or stale
+def load_id_index(data_file):
+    name = ids_file_name(data_file)
+    if os.path.exists(name):
+        with np.load(name) as index:
+            if np.array_equal(index['stamp'], _stamp(data_file)):
+                return index['ids'], index['offsets']
+
+    ids, offsets = build_id_index(data_file)
+    tmp_name = temporary_file_name(name)
+    try:
+        with open(tmp_name, 'wb') as fl:
+            np.savez(fl, ids=ids, offsets=offsets, stamp=_stamp(data_file))
+        os.replace(tmp_name, name)
+    except OSError:
+        pass
+    finally:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+    return ids, offsets
+
+
+def read_rows(data_file, offsets):
+    """
+    Reads the rows starting at offsets, in the order given.
+    Uncompressed files are read with one seek per row, compressed ones in a
+    single forward pass over the rows in file order.
+    """
+    unique, inverse = np.unique(np.asarray(offsets, dtype=np.int64), return_inverse=True)
+    rows = np.empty((len(unique), 0))
+    with open_binary(data_file) as fl:
+        position = 0
+        parsed = []
+        for offset in unique.tolist():
+            if fl.seekable():
+                fl.seek(offset)
+            else:
+                skip_to(fl, position, offset)
+            line = fl.readline()
+            position = offset + len(line)
+            parsed.append([float(ele) for ele in line.split(b',')])
+        if parsed:
+            rows = np.array(parsed)
+    return rows[inverse.reshape(-1)]
+
+
+class ExampleReader:
+    """
+    Random access to the n-step examples of a group of part files, flagged or not.
+
+    Parameters
+    ----------
+    data_file : str ,
+        Any of the part files, the others are found by their _k_of_n names.
+    """
+
+    def __init__(self, data_file):
+        self.names = part_file_names(data_file)
+        for name in self.names:
+            if not os.path.exists(name):
+                raise ValueError('part file does not exist: ' + str(name))
+        self.header = read_header(self.names[0])
+        self.indexes = [load_id_index(name) for name in self.names]
+
+    def __len__(self):
+        return len(self.indexes[0][0])
+
+    # All the example ids, in increasing order
+    def ids(self):
+        return self.indexes[0][0]
+
+    def fetch(self, ids):
+        """
+        Parameters
+        ----------
+        ids : list ,
+            Example ids, in any order, repeats allowed.
+
+        Raises
+        ------
+        ValueError
+            If an id is not in one of the part files.
+
+        Returns
+        -------
+        examples : np.array ,
+            (batch, number_of_steps, columns) float64 rows, columns as in header.
+        """
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        examples = np.empty((len(ids), len(self.names), len(self.header)))
+        for part, (name, (index_ids, offsets)) in enumerate(zip(self.names, self.indexes)):
+            positions = np.searchsorted(index_ids, ids)
+            if len(index_ids) == 0:
+                missing = np.ones(len(ids), dtype=bool)
+            else:
+                missing = index_ids[np.minimum(positions, len(index_ids) - 1)] != ids
+            if np.any(missing):
+                raise ValueError('example ids not in ' + str(name) + ': ' + str(ids[missing][:10].tolist()))
+            examples[:, part] = read_rows(name, offsets[positions])
+        return examples
@@ -0,0 +1,11 @@
+from os import listdir
+from os.path import isfile, join
+
+# Extensions of the state files written by the processor and the flagger
+STATE_FILE_EXTENSIONS = ('.csv', '.csv.gz', '.csv.zst')
+
+
+# Collect the state files in a directory, skipping logs and sidecar files
+def list_state_files(source_dir):
+    return sorted(f for f in listdir(source_dir)
+                  if isfile(join(source_dir, f)) and f.endswith(STATE_FILE_EXTENSIONS))
@@ -0,0 +1,259 @@
+import os
+import numpy as np
+
+from CommonUtils.FileManipulationTools import list_state_files
+from CommonUtils.CompressedFiles import StateFileWriter, compression_of, open_binary
+from CommonUtils.TrajectoryIndex import TrajectoryIndexBuilder, load_entries, read_index
+from CommonUtils.RunningStatistics import RunningStatistics, statistics_file_name
+from CommonUtils.AtomicFiles import AtomicFile, write_manifest
+from CommonUtils.StateSchema import STATE_DTYPE, STATE_HEADERS, as_array
+from CommonUtils.StateTable import StateTable, list_state_tables, window_index_files, states_file_name, segments_file_name, windows_file_name
+from CommonUtils.TrajectorySummary import summary_file_name, read_summary, write_summary, shift_summary
+
+# Partitions of a run (ProcessTrajectories.py --partition k/N) number their
+# examples and trajectories from 0. Merging concatenates the files of the
+# partitions and shifts the id (first field) and trajectory (last field) of
+# every row of partition p by the number of examples and trajectories of the
+# partitions before it. The other fields are copied as bytes, never parsed.
+# State tables (--layout table) are concatenated the same way: the trajectory
+# of every state and the ids of the windows are shifted, the segment and window
+# start rows move by the number of states before them.
+
+# Rows are written in blocks of this many lines
+BLOCK_LINES = 10000
+
+
+def partition_extent(directory):
+    """
+    The number of example ids and trajectory indexes used by the outputs of a
+    partition. Examples: one past the largest id of any of its files, read
+    from the statistics sidecars or, without them, from the trajectory indexes.
+    Trajectories: every source file the partition processed has a row in its
+    trajectory summary, also the ones that wrote no examples (no overlapping
+    streams, every example dropped by the contact filter), so they are counted
+    from the summary. Without a summary, one past the largest trajectory of
+    any of its files.
+
+    Returns
+    -------
+    examples, trajectories : int
+    """
+    examples = 0
+    trajectories = 0
+    for f in list_state_files(directory):
+        path = os.path.join(directory, f)
+        if os.path.exists(statistics_file_name(path)):
+            stats = RunningStatistics.read(path)
+            if stats.count == 0:
+                continue
+            examples = max(examples, int(stats.max[stats.columns.index("id")]) + 1)
+            trajectories = max(trajectories, int(stats.max[stats.columns.index("trajectory")]) + 1)
+        else:
+            for entry in load_entries(path):
+                examples = max(examples, entry.last_id + 1)
+                trajectories = max(trajectories, entry.trajectory + 1)
+    for name in list_state_tables(directory):
+        for path in window_index_files(name).values():
+            windows = np.load(path)
+            if len(windows) > 0:
+                examples = max(examples, int(windows[:, 0].max()) + 1)
+        states = np.load(states_file_name(name), mmap_mode='r')
+        if len(states) > 0:
+            trajectories = max(trajectories, int(states["trajectory"].max()) + 1)
+    if os.path.exists(summary_file_name(directory)):
+        for row in read_summary(directory):
+            trajectories = max(trajectories, int(row['trajectory']) + 1)
+    return examples, trajectories
+
+
+# Add offset to an integer field, keeping the way it was written (123 or 123.0)
+def _shift(field, offset):
+    if offset == 0:
+        return field
+    if b'.' in field or b'e' in field:
+        return str(float(field) + offset).encode()
+    return str(int(field) + offset).encode()
+
+
+def merge_file(inputs, out_path):
+    """
+    Parameters
+    ----------
+    inputs : list ,
+        (path, id_offset, trajectory_offset) of the file in every partition, in order.
+    out_path : str ,
+        The merged file, compressed according to its extension.
+
+    Raises
+    ------
+    ValueError
+        If the headers of the inputs differ.
+    """
+    # Sidecars can only be carried over when every input has them
+    indexed = all(read_index(path) is not None for path, _, _ in inputs)
+    with_statistics = all(os.path.exists(statistics_file_name(path)) for path, _, _ in inputs)
+
+    out_index = TrajectoryIndexBuilder()
+    statistics = None
+    header = None
+    outf = StateFileWriter(out_path, compression_of(out_path))
+    try:
+        for path, id_offset, trajectory_offset in inputs:
+            with open_binary(path) as fl:
+                file_header = fl.readline()
+                if header is None:
+                    header = file_header
+                    outf.write(header)
+                elif file_header != header:
+                    raise ValueError('The header of ' + str(path) + ' differs from the other partitions')
+
+                block = []
+                position = outf.tell()
+                for line in fl:
+                    body = line.rstrip(b'\r\n')
+                    if not body:
+                        continue
+                    first, rest = body.split(b',', 1)
+                    rest, last = rest.rsplit(b',', 1)
+                    first = _shift(first, id_offset)
+                    last = _shift(last, trajectory_offset)
+                    line = first + b',' + rest + b',' + last + line[len(body):]
+                    if indexed:
+                        out_index.add(int(float(last)), position, 1, int(float(first)))
+                    position += len(line)
+                    block.append(line)
+                    if len(block) >= BLOCK_LINES:
+                        outf.write(b''.join(block))
+                        block = []
+                outf.write(b''.join(block))
+
+            if with_statistics:
+                stats = RunningStatistics.read(path)
+                # Shifting a column moves its mean and extrema, its variance stays the same
+                for column, offset in (("id", id_offset), ("trajectory", trajectory_offset)):
+                    i = stats.columns.index(column)
+                    stats.mean[i] += offset
+                    stats.min[i] += offset
+                    stats.max[i] += offset
+                statistics = stats if statistics is None else statistics.merge(stats)
+    except BaseException:
+        outf.abort()
+        raise
+
+    outf.close()
+    if indexed:
+        out_index.write(out_path)
+    if statistics is not None:
+        statistics.write(out_path)
+    write_manifest(out_path, outf.lines - 1, outf.checksum())
+
+
+def merge_table(inputs, out_name):
+    """
+    Parameters
+    ----------
+    inputs : list ,
+        (name, id_offset, trajectory_offset) of the table in every partition, in order.
+    out_name : str ,
+        The merged table, i.e. the path without the _states.npy suffix.
+
+    Raises
+    ------
+    ValueError
+        If the partitions were written with different numbers of steps.
+    """
+    tables = [(StateTable(name), id_offset, trajectory_offset) for name, id_offset, trajectory_offset in inputs]
+    steps = set(window_index_files(inputs[0][0]))
+    for name, _, _ in inputs[1:]:
+        if set(window_index_files(name)) != steps:
+            raise ValueError('The window indexes of ' + str(name) + ' differ from the other partitions')
+    rows = sum(len(table.states) for table, _, _ in tables)
+
+    statistics = RunningStatistics(STATE_HEADERS)
+    states = AtomicFile(states_file_name(out_name))
+    try:
+        with states as fl:
+            np.lib.format.write_array_header_1_0(fl, {
+                'descr': np.lib.format.dtype_to_descr(STATE_DTYPE),
+                'fortran_order': False,
+                'shape': (rows,)})
+            for table, _, trajectory_offset in tables:
+                for start in range(0, len(table.states), BLOCK_LINES):
+                    block = np.array(table.states[start:start + BLOCK_LINES])
+                    block["trajectory"] += trajectory_offset
+                    statistics.update(as_array(block))
+                    fl.write(block.tobytes())
+    except BaseException:
+        states.abort()
+        raise
+
+    segments = [np.zeros(1, dtype=np.int64)]
+    windows = {number_of_steps: [] for number_of_steps in steps}
+    row_offset = 0
+    for (table, id_offset, _), (name, _, _) in zip(tables, inputs):
+        segments.append(table.segments[1:] + row_offset)
+        for number_of_steps, path in window_index_files(name).items():
+            window_index = np.load(path)
+            windows[number_of_steps].append(window_index + np.array([id_offset, row_offset], dtype=np.int64))
+        row_offset += len(table.states)
+
+    with AtomicFile(segments_file_name(out_name)) as fl:
+        np.save(fl, np.concatenate(segments).astype(np.int64))
+    for number_of_steps, blocks in windows.items():
+        with AtomicFile(windows_file_name(out_name, number_of_steps)) as fl:
+            np.save(fl, np.concatenate(blocks).astype(np.int64))
+    statistics.write(states_file_name(out_name))
+    write_manifest(states_file_name(out_name), rows, states.checksum())
+
+
+def merge_partitions(partition_dirs, out_dir):
+    """
+    Merges the outputs of partitioned runs (part, vel/acc and Flagged files,
+    state tables and the trajectory summaries).
+    A file missing from a partition is skipped for that partition.
+
+    Returns
+    -------
+    merged : list ,
+        The paths of the merged files.
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    offsets = []
+    examples = 0
+    trajectories = 0
+    for directory in partition_dirs:
+        offsets.append((examples, trajectories))
+        extent = partition_extent(directory)
+        examples += extent[0]
+        trajectories += extent[1]
+
+    names = sorted(set(f for directory in partition_dirs for f in list_state_files(directory)))
+    merged = []
+    for name in names:
+        inputs = [(os.path.join(directory, name), id_offset, trajectory_offset)
+                  for directory, (id_offset, trajectory_offset) in zip(partition_dirs, offsets)
+                  if os.path.exists(os.path.join(directory, name))]
+        out_path = os.path.join(out_dir, name)
+        merge_file(inputs, out_path)
+        merged.append(out_path)
+
+    tables = sorted(set(os.path.basename(name) for directory in partition_dirs for name in list_state_tables(directory)))
+    for table in tables:
+        inputs = [(os.path.join(directory, table), id_offset, trajectory_offset)
+                  for directory, (id_offset, trajectory_offset) in zip(partition_dirs, offsets)
+                  if os.path.exists(states_file_name(os.path.join(directory, table)))]
+        out_name = os.path.join(out_dir, table)
+        merge_table(inputs, out_name)
+        merged.append(states_file_name(out_name))
+
+    # The trajectory summaries, renumbered like the rows
+    summaries = []
+    for directory, (_, trajectory_offset) in zip(partition_dirs, offsets):
+        if os.path.exists(summary_file_name(directory)):
+            summaries += shift_summary(read_summary(directory), trajectory_offset)
+    if summaries:
+        write_summary(out_dir, summaries)
+        merged.append(summary_file_name(out_dir))
+    return merged
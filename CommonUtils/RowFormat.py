@@ -0,0 +1,58 @@
+import itertools
+import numpy as np
+
+# Columns that only ever hold integer values
+INTEGER_COLUMNS = ["id", "base_vel", "base_acc", "in_contact", "trajectory"]
+
+# Precisions of the output values
+DTYPES = {'float64': np.float64, 'float32': np.float32}
+
+# Significant digits that make a float32 round trip through text
+FLOAT32_DIGITS = 9
+
+
+class RowFormatter:
+    """
+    Formats whole (rows, columns) blocks into csv text with a single % over
+    a format string repeated for every row.
+
+    By default every value is written as repr(float), exactly as csv.writer
+    does. With a precision (significant digits) or dtype float32 the values
+    are rounded accordingly and the integer columns are written as integers,
+    which makes the files smaller and faster to write. Either way the readers
+    parse every field with float().
+    """
+
+    def __init__(self, header, precision=None, dtype=None):
+        if dtype is not None and dtype not in DTYPES:
+            raise ValueError('dtype has to be one of: ' + ", ".join(DTYPES))
+        if precision is not None and precision < 1:
+            raise ValueError('precision has to be a positive number of significant digits: ' + str(precision))
+        self.header = list(header)
+        self.dtype = DTYPES[dtype] if dtype is not None else None
+        # Only the value columns are rounded, ids and trajectory indexes stay exact
+        self.float_columns = np.array([name not in INTEGER_COLUMNS for name in self.header])
+        self.compact = precision is not None or dtype is not None
+        if not self.compact:
+            value_format = '%r'
+        elif precision is not None:
+            value_format = '%.' + str(precision) + 'g'
+        elif dtype == 'float32':
+            value_format = '%.' + str(FLOAT32_DIGITS) + 'g'
+        else:
+            value_format = '%r'
+        column_formats = [('%d' if self.compact and name in INTEGER_COLUMNS else value_format) for name in self.header]
+        self.row_format = ','.join(column_formats) + '\r\n'
+
+    def format(self, rows):
+        rows = np.asarray(rows)
+        if len(rows) == 0:
+            return ''
+        if rows.shape[1] != len(self.header):
+            raise ValueError('rows have ' + str(rows.shape[1]) + ' columns, the header has ' + str(len(self.header)))
+        if self.dtype is not None:
+            # Round to the precision of the dtype, formatted from float64 so %r/%g see plain floats
+            rows = rows.astype(np.float64)
+            rows[:, self.float_columns] = rows[:, self.float_columns].astype(self.dtype)
+        values = tuple(itertools.chain.from_iterable(rows.tolist()))
+        return (self.row_format * len(rows)) % values
@@ -0,0 +1,91 @@
+import json
+import numpy as np
+
+from CommonUtils.AtomicFiles import write_text_atomically
+
+
+# The statistics sidecar lives next to the data file
+def statistics_file_name(data_file):
+    return str(data_file) + '.stats.json'
+
+
+class RunningStatistics:
+    """
+    Per-column count, mean, variance, min and max of a stream of row blocks.
+
+    Blocks are folded in with the pairwise update of Chan et al., which is
+    numerically stable and lets accumulators of different workers (or of
+    different partitions of a run) be merged exactly with merge.
+    """
+
+    def __init__(self, columns):
+        self.columns = list(columns)
+        self.count = 0
+        self.mean = np.zeros(len(self.columns))
+        self.m2 = np.zeros(len(self.columns))
+        self.min = np.full(len(self.columns), np.inf)
+        self.max = np.full(len(self.columns), -np.inf)
+
+    def _combine(self, count, mean, m2, minimum, maximum):
+        if count == 0:
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (count / total)
+        self.m2 = self.m2 + m2 + delta**2 * (self.count * count / total)
+        self.count = total
+        self.min = np.minimum(self.min, minimum)
+        self.max = np.maximum(self.max, maximum)
+
+    # Fold a (rows, columns) block into the statistics
+    def update(self, block):
+        block = np.asarray(block, dtype=np.float64)
+        if len(block) == 0:
+            return
+        mean = block.mean(axis=0)
+        m2 = ((block - mean)**2).sum(axis=0)
+        self._combine(len(block), mean, m2, block.min(axis=0), block.max(axis=0))
+
+    def merge(self, other):
+        if other.columns != self.columns:
+            raise ValueError('Cannot merge statistics of different columns')
+        self._combine(other.count, other.mean, other.m2, other.min, other.max)
+        return self
+
+    def variance(self):
+        if self.count == 0:
+            return np.full(len(self.columns), np.nan)
+        return self.m2 / self.count
+
+    def to_dict(self):
+        std = np.sqrt(self.variance())
+        columns = {}
+        for i, name in enumerate(self.columns):
+            columns[name] = {
+                "mean": float(self.mean[i]) if self.count else None,
+                "std": float(std[i]) if self.count else None,
+                "min": float(self.min[i]) if self.count else None,
+                "max": float(self.max[i]) if self.count else None,
+                "m2": float(self.m2[i])}
+        return {"count": self.count, "columns": columns}
+
+    @classmethod
+    def from_dict(cls, stats_dict):
+        columns = list(stats_dict["columns"])
+        stats = cls(columns)
+        stats.count = int(stats_dict["count"])
+        if stats.count:
+            values = [stats_dict["columns"][name] for name in columns]
+            stats.mean = np.array([value["mean"] for value in values])
+            stats.m2 = np.array([value["m2"] for value in values])
+            stats.min = np.array([value["min"] for value in values])
+            stats.max = np.array([value["max"] for value in values])
+        return stats
+
+    def write(self, data_file):
+        write_text_atomically(statistics_file_name(data_file), json.dumps(self.to_dict(), indent=2))
+
+    @classmethod
+    def read(cls, data_file):
+        with open(statistics_file_name(data_file)) as fl:
+            return cls.from_dict(json.load(fl))
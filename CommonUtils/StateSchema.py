@@ -0,0 +1,83 @@
+import numpy as np
+
+# Column layout of a state, as written by the processor after the id column
+STATE_HEADERS = [
+    "o_t_r_x",
+    "o_t_r_y",
+    "o_t_l_x",
+    "o_t_l_y",
+    "o_b_r_x",
+    "o_b_r_y",
+    "o_b_l_x",
+    "o_b_l_y",
+    "o_m_m_x",
+    "o_m_m_y",
+    "o_pos_x",
+    "o_pos_y",
+    "o_angle",
+    "e_pos_x",
+    "e_pos_y",
+    "e_angle",
+    "force_x",
+    "force_y",
+    "torque",
+    "base_vel",
+    "base_acc",
+    "trajectory"]
+
+# The flagger inserts the contact flag before the trajectory index
+FLAGGED_STATE_HEADERS = STATE_HEADERS[:-1] + ["in_contact", "trajectory"]
+
+# Headers of the output files, every row starts with the example id
+EXAMPLE_HEADERS = ["id"] + STATE_HEADERS
+FLAGGED_EXAMPLE_HEADERS = ["id"] + FLAGGED_STATE_HEADERS
+
+"""
+Structured dtypes of the state records. All fields are float64 and laid out
+in header order, so a plain (rows, columns) float64 array and a record array
+share the same memory: grouped fields such as `nodes` or `tip` are zero-copy
+views of the corresponding columns.
+"""
+_STATE_FIELDS = [
+    ("nodes", np.float64, (10,)),   # o_t_r_x ... o_m_m_y
+    ("obj", np.float64, (3,)),      # o_pos_x, o_pos_y, o_angle
+    ("tip", np.float64, (3,)),      # e_pos_x, e_pos_y, e_angle
+    ("ft", np.float64, (3,)),       # force_x, force_y, torque
+    ("base_vel", np.float64),
+    ("base_acc", np.float64)]
+
+STATE_DTYPE = np.dtype(_STATE_FIELDS + [("trajectory", np.float64)])
+FLAGGED_STATE_DTYPE = np.dtype(_STATE_FIELDS + [("in_contact", np.float64), ("trajectory", np.float64)])
+
+EXAMPLE_DTYPE = np.dtype([("id", np.float64)] + _STATE_FIELDS + [("trajectory", np.float64)])
+FLAGGED_EXAMPLE_DTYPE = np.dtype([("id", np.float64)] + _STATE_FIELDS +
+                                 [("in_contact", np.float64), ("trajectory", np.float64)])
+
+
+# The record dtype matching the header of an output file
+def example_dtype(header):
+    if "in_contact" in header:
+        return FLAGGED_EXAMPLE_DTYPE
+    return EXAMPLE_DTYPE
+
+
+def as_records(array, dtype):
+    """
+    View a (rows, columns) float array as records of dtype.
+    No data is copied when the array already is C-contiguous float64.
+
+    Raises
+    ------
+    ValueError
+        If the number of columns does not match the dtype.
+    """
+    array = np.ascontiguousarray(np.atleast_2d(array), dtype=np.float64)
+    if array.shape[1] * array.itemsize != dtype.itemsize:
+        raise ValueError('Rows with ' + str(array.shape[1]) + ' columns do not match the schema: ' +
+                         str(dtype.names))
+    return array.view(dtype).reshape(len(array))
+
+
+# View records as a plain (rows, columns) float64 array, without copying
+def as_array(records):
+    return records.view(np.float64).reshape(len(records), records.dtype.itemsize // 8)
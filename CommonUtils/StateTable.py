@@ -0,0 +1,184 @@
+import os
+import shutil
+import zlib
+import numpy as np
+
+from CommonUtils.StateSchema import STATE_DTYPE, STATE_HEADERS, as_array, as_records
+from CommonUtils.RunningStatistics import RunningStatistics
+from CommonUtils.AtomicFiles import AtomicFile, temporary_file_name, write_manifest
+
+# Compact output layout: every resampled state is stored exactly once.
+#     <name>_states.npy         STATE_DTYPE records, trajectories one after the other
+#     <name>_segments.npy       int64 start row of every unbroken segment, plus the end row
+#     <name>_windows_n=<n>.npy  int64 (examples, 2) array of example id and start row
+# An n-step example is states[start:start+n], a zero-copy view. Windows never
+# cross segment boundaries, so changing n only needs a new window index
+# (build_window_index), the states are untouched.
+
+
+def states_file_name(name):
+    return str(name) + "_states.npy"
+
+
+def segments_file_name(name):
+    return str(name) + "_segments.npy"
+
+
+def windows_file_name(name, number_of_steps):
+    return str(name) + "_windows_n=" + str(number_of_steps) + ".npy"
+
+
+# The tables of a directory, as names without the _states.npy suffix
+def list_state_tables(directory):
+    return sorted(os.path.join(directory, f[:-len("_states.npy")]) for f in os.listdir(directory)
+                  if f.endswith("_states.npy") and os.path.isfile(os.path.join(directory, f)))
+
+
+# The window indexes written for a table, number of steps -> path
+def window_index_files(name):
+    directory, prefix = os.path.split(str(name))
+    prefix += "_windows_n="
+    files = {}
+    for f in os.listdir(directory or '.'):
+        if f.startswith(prefix) and f.endswith(".npy") and f[len(prefix):-len(".npy")].isdigit():
+            files[int(f[len(prefix):-len(".npy")])] = os.path.join(directory, f)
+    return files
+
+
+# Start rows of every n-step window that fits inside a segment
+def build_window_index(segments, number_of_steps, first_id=0):
+    starts = [np.arange(start, end - number_of_steps + 1)
+              for start, end in zip(segments[:-1], segments[1:]) if end - start >= number_of_steps]
+    starts = np.concatenate(starts) if starts else np.array([], dtype=np.int64)
+    ids = np.arange(first_id, first_id + len(starts))
+    return np.column_stack((ids, starts)).astype(np.int64)
+
+
+class StateTableWriter:
+    """
+    Appends unbroken segments of states to a state table and writes the
+    window index of number_of_steps next to it. The states are streamed to a
+    temporary file and prefixed with the .npy header on close, once their
+    number is known. With a shuffle buffer the rows of the window index are
+    shuffled within buffers of that many examples, the states keep their order.
+    Every file is committed atomically, the manifest of the states is written last.
+    """
+
+    def __init__(self, name, number_of_steps, shuffle_buffer=0, seed=0):
+        self.name = name
+        self.number_of_steps = number_of_steps
+        self.shuffle_buffer = shuffle_buffer
+        self.rng = np.random.default_rng([seed, zlib.crc32(str(name).encode())])
+        self.rows = 0
+        self.segments = [0]
+        self.windows = []
+        self.statistics = RunningStatistics(STATE_HEADERS)
+        self.tmp_name = temporary_file_name(states_file_name(name))
+        self.raw = open(self.tmp_name, 'wb')
+
+    def write(self, ids, traj, starts=None):
+        """
+        Parameters
+        ----------
+        ids : np.array ,
+            The example id of every window of traj.
+        traj : np.array ,
+            (rows, columns) unbroken segment of states.
+        starts : np.array ,
+            The first row of every window in traj, when only some windows are
+            kept (e.g. the ones in contact). By default every window is an example.
+        """
+        records = as_records(traj, STATE_DTYPE)
+        self.raw.write(records.tobytes())
+        self.statistics.update(as_array(records))
+        if starts is None:
+            starts = np.arange(len(ids))
+        starts = self.rows + np.asarray(starts)
+        self.windows.append(np.column_stack((ids, starts)).astype(np.int64))
+        self.rows += len(records)
+        self.segments.append(self.rows)
+
+    def close(self):
+        self.raw.close()
+        states = AtomicFile(states_file_name(self.name))
+        try:
+            with states as fl, open(self.tmp_name, 'rb') as raw:
+                np.lib.format.write_array_header_1_0(fl, {
+                    'descr': np.lib.format.dtype_to_descr(STATE_DTYPE),
+                    'fortran_order': False,
+                    'shape': (self.rows,)})
+                shutil.copyfileobj(raw, fl)
+        finally:
+            os.remove(self.tmp_name)
+
+        windows = np.concatenate(self.windows) if self.windows else np.zeros((0, 2), dtype=np.int64)
+        if self.shuffle_buffer > 0:
+            for start in range(0, len(windows), self.shuffle_buffer):
+                block = windows[start:start + self.shuffle_buffer]
+                windows[start:start + self.shuffle_buffer] = block[self.rng.permutation(len(block))]
+        with AtomicFile(segments_file_name(self.name)) as fl:
+            np.save(fl, np.array(self.segments, dtype=np.int64))
+        with AtomicFile(windows_file_name(self.name, self.number_of_steps)) as fl:
+            np.save(fl, windows)
+        self.statistics.write(states_file_name(self.name))
+        write_manifest(states_file_name(self.name), self.rows, states.checksum())
+
+    # Discard the streamed states, a previous table stays as it was
+    def abort(self):
+        self.raw.close()
+        if os.path.exists(self.tmp_name):
+            os.remove(self.tmp_name)
+
+
+class StateTable:
+    """
+    Reader of the compact layout. The states are memory mapped, examples are
+    zero-copy views into them.
+
+    Parameters
+    ----------
+    name : str ,
+        The table name, i.e. the path without the _states.npy suffix.
+    """
+
+    def __init__(self, name):
+        if name.endswith("_states.npy"):
+            name = name[:-len("_states.npy")]
+        self.name = name
+        self.states = np.load(states_file_name(name), mmap_mode='r')
+        self.segments = np.load(segments_file_name(name))
+
+    # The window index of n-step examples, built and saved when it does not exist yet
+    def window_index(self, number_of_steps):
+        path = windows_file_name(self.name, number_of_steps)
+        if os.path.exists(path):
+            return np.load(path)
+        windows = build_window_index(self.segments, number_of_steps)
+        try:
+            with AtomicFile(path) as fl:
+                np.save(fl, windows)
+        except OSError:
+            pass
+        return windows
+
+    # The n-step example starting at row start, as a view of the states
+    def example(self, start, number_of_steps):
+        return self.states[start:start + number_of_steps]
+
+    def examples(self, number_of_steps):
+        """
+        Returns
+        -------
+        ids : np.array ,
+            The example ids.
+        windows : np.array ,
+            (examples, number_of_steps) records, windows[i] is the example ids[i].
+            When the windows start on consecutive rows (one segment, no shuffling)
+            this is a zero-copy strided view of the states, otherwise they are gathered.
+        """
+        index = self.window_index(number_of_steps)
+        all_windows = np.lib.stride_tricks.sliding_window_view(self.states, number_of_steps)
+        starts = index[:, 1]
+        if len(starts) and np.all(np.diff(starts) == 1):
+            return index[:, 0], all_windows[starts[0]:starts[-1] + 1]
+        return index[:, 0], all_windows[starts]
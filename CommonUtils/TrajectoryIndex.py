@@ -0,0 +1,248 @@
+import io
+import os
+import csv
+import numpy as np
+
+from collections import namedtuple
+
+from CommonUtils.CompressedFiles import open_binary, open_text, skip_to
+from CommonUtils.AtomicFiles import write_text_atomically
+
+# One row of the sidecar index: where the rows of a trajectory start in the
+# data file (in bytes), how many rows it has and which example ids it spans.
+IndexEntry = namedtuple('IndexEntry', ['trajectory', 'offset', 'rows', 'first_id', 'last_id'])
+
+INDEX_HEADER = ['trajectory', 'offset', 'rows', 'first_id', 'last_id']
+
+
+# The sidecar index lives next to the data file
+def index_file_name(data_file):
+    return str(data_file) + '.idx'
+
+
+# Size and modification time of the data file, used to detect stale indexes
+def _file_stamp(data_file):
+    stat = os.stat(data_file)
+    return stat.st_size, stat.st_mtime_ns
+
+
+class TrajectoryIndexBuilder:
+    """
+    Collects index entries while a data file is being written.
+    Consecutive blocks of the same trajectory with consecutive ids are merged
+    into a single entry, so a trajectory that is written in several pieces is
+    still seekable in one go.
+    """
+
+    def __init__(self):
+        self.entries = []
+
+    def add(self, trajectory, offset, rows, first_id):
+        if rows <= 0:
+            return
+        trajectory = int(trajectory)
+        first_id = int(first_id)
+        if self.entries:
+            last = self.entries[-1]
+            if last.trajectory == trajectory and last.last_id + 1 == first_id:
+                self.entries[-1] = last._replace(rows=last.rows + rows, last_id=first_id + rows - 1)
+                return
+        self.entries.append(IndexEntry(trajectory, int(offset), int(rows), first_id, first_id + rows - 1))
+
+    def write(self, data_file):
+        write_index(data_file, self.entries)
+
+
+def write_index(data_file, entries):
+    size, mtime_ns = _file_stamp(data_file)
+    fl = io.StringIO(newline='')
+    fl.write('# size=' + str(size) + ' mtime_ns=' + str(mtime_ns) + '\n')
+    writer = csv.writer(fl)
+    writer.writerow(INDEX_HEADER)
+    for entry in entries:
+        writer.writerow(entry)
+    write_text_atomically(index_file_name(data_file), fl.getvalue())
+
+
+# Read the index of data_file, returns None if it is missing or stale
+def read_index(data_file):
+    name = index_file_name(data_file)
+    if not os.path.exists(name):
+        return None
+
+    with open(name, mode='r', newline='') as fl:
+        stamp = fl.readline().split()
+        try:
+            size = int(stamp[1].split('=')[1])
+            mtime_ns = int(stamp[2].split('=')[1])
+        except (IndexError, ValueError):
+            return None
+        if (size, mtime_ns) != _file_stamp(data_file):
+            return None
+
+        reader = csv.reader(fl)
+        if next(reader, None) != INDEX_HEADER:
+            return None
+        return [IndexEntry(*[int(ele) for ele in row]) for row in reader]
+
+
+def read_header(data_file):
+    with open_text(data_file) as fl:
+        return next(csv.reader(fl), [])
+
+
+# Scan the data file once, only looking at the id and trajectory fields of each row.
+# Offsets are positions in the uncompressed stream of compressed files.
+def build_index(data_file):
+    header = read_header(data_file)
+    traj_col = header.index('trajectory') if 'trajectory' in header else len(header) - 1
+
+    builder = TrajectoryIndexBuilder()
+    with open_binary(data_file) as fl:
+        offset = len(fl.readline())
+        current = None
+        for line in iter(fl.readline, b''):
+            fields = line.split(b',')
+            try:
+                traj_index = int(float(fields[traj_col]))
+                line_id = int(float(fields[0]))
+            except (IndexError, ValueError):
+                offset += len(line)
+                continue
+            if current is not None and current[0] == traj_index and current[3] + current[2] == line_id:
+                current[2] += 1
+            else:
+                if current is not None:
+                    builder.add(*current)
+                current = [traj_index, offset, 1, line_id]
+            offset += len(line)
+        if current is not None:
+            builder.add(*current)
+
+    return builder.entries
+
+
+# The entries of data_file in file order. The sidecar index is used when it
+# is up to date, otherwise it is rebuilt from the data file and written back.
+def load_entries(data_file):
+    entries = read_index(data_file)
+    if entries is None:
+        entries = build_index(data_file)
+        try:
+            write_index(data_file, entries)
+        except OSError:
+            pass
+    return entries
+
+
+def load_index(data_file):
+    """
+    Returns a dictionary from trajectory index to IndexEntry for data_file.
+    The sidecar index is used when it is up to date, otherwise it is rebuilt
+    from the data file and written back next to it.
+
+    Raises
+    ------
+    ValueError
+        If the rows of a trajectory are not stored contiguously in the file,
+        as in shuffled files. Use load_fragments for those.
+    """
+    index = {}
+    for entry in load_entries(data_file):
+        if entry.trajectory in index:
+            raise ValueError('The rows of trajectory ' + str(entry.trajectory) +
+                             ' are not contiguous in: ' + str(data_file))
+        index[entry.trajectory] = entry
+    return index
+
+
+def load_fragments(data_file):
+    """
+    Returns a dictionary from trajectory index to the list of its entries in
+    file order. Unshuffled files have a single entry per trajectory, the rows
+    of a trajectory in a shuffled file are scattered over many fragments.
+    """
+    fragments = {}
+    for entry in load_entries(data_file):
+        fragments.setdefault(entry.trajectory, []).append(entry)
+    return fragments
+
+
+# Number of rows of a trajectory over all its fragments
+def fragment_rows(fragments):
+    return sum(entry.rows for entry in fragments)
+
+
+# Seek straight to a trajectory and return its raw csv rows,
+# with stride > 1 only every stride-th row is decoded and parsed
+def read_trajectory_rows(data_file, entry, stride=1):
+    for _, rows in iter_trajectory_rows(data_file, [entry], stride):
+        return rows
+
+
+# Read the rows of several trajectories with a single open file, in file order.
+# stride is one stride for all entries or a list with the stride of every entry.
+# Compressed files cannot seek, they are decompressed up to each offset instead.
+def iter_trajectory_rows(data_file, entries, stride=1):
+    entries = list(entries)
+    strides = list(stride) if isinstance(stride, (list, tuple)) else [stride] * len(entries)
+    with open_binary(data_file) as fl:
+        position = 0
+        for entry, entry_stride in sorted(zip(entries, strides), key=lambda pair: pair[0].offset):
+            position = skip_to(fl, position, entry.offset)
+            lines = []
+            for i in range(entry.rows):
+                line = fl.readline()
+                position += len(line)
+                if i % entry_stride == 0:
+                    lines.append(line.decode())
+            yield entry, list(csv.reader(lines, delimiter=','))
+
+
+def read_trajectory(data_file, entry):
+    rows = read_trajectory_rows(data_file, entry)
+    return np.array([[float(ele) for ele in row] for row in rows])
+
+
+# Read whole trajectories, given as lists of fragments, in one pass over the file.
+# The fragments of a trajectory are put back in id order before every stride-th row is kept.
+def read_fragmented_rows(data_file, trajectories, stride=1):
+    trajectories = [list(fragments) for fragments in trajectories]
+    strides = list(stride) if isinstance(stride, (list, tuple)) else [stride] * len(trajectories)
+
+    entries = []
+    entry_strides = []
+    for fragments, trajectory_stride in zip(trajectories, strides):
+        for entry in fragments:
+            entries.append(entry)
+            # A single fragment is already in order, only its rendered rows are parsed
+            entry_strides.append(trajectory_stride if len(fragments) == 1 else 1)
+    pieces = {}
+    for entry, rows in iter_trajectory_rows(data_file, entries, entry_strides):
+        pieces[entry.offset] = rows
+
+    result = []
+    for fragments, trajectory_stride in zip(trajectories, strides):
+        if len(fragments) == 1:
+            result.append(pieces[fragments[0].offset])
+            continue
+        rows = []
+        for entry in sorted(fragments, key=lambda entry: entry.first_id):
+            rows += pieces[entry.offset]
+        result.append(rows[::trajectory_stride])
+    return result
+
+
+# Parse an index specification like "0-9,15,20-22" into a sorted list of indices
+def parse_index_spec(spec):
+    indices = set()
+    for part in str(spec).split(','):
+        part = part.strip()
+        if part == '':
+            continue
+        if '-' in part:
+            start, end = part.split('-', 1)
+            indices.update(range(int(start), int(end) + 1))
+        else:
+            indices.add(int(part))
+    return sorted(indices)
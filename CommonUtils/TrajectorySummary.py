@@ -0,0 +1,157 @@
+import io
+import os
+import re
+import csv
+import numpy as np
+
+from CommonUtils.AtomicFiles import write_text_atomically
+from CommonUtils.StateSchema import STATE_DTYPE, as_records
+from CommonUtils.ContactGeometry import contact_distance
+
+# One row per trajectory of a run, written next to its outputs by the processor
+# and the flagger. The .tsv extension keeps it out of list_state_files.
+SUMMARY_FILE_NAME = 'trajectory_summary.tsv'
+
+PROPERTY_COLUMNS = ['shape', 'vel', 'acc', 'push_angle', 'push_side', 'push_point', 'split']
+
+SUMMARY_COLUMNS = (['trajectory', 'source'] + PROPERTY_COLUMNS +
+                   ['rows', 'examples', 'duration',
+                    'force_x_min', 'force_x_max', 'force_y_min', 'force_y_max', 'torque_min', 'torque_max',
+                    'contact_ratio'])
+
+# Time between two resampled states, in seconds
+STATE_STEP = 0.01
+
+
+def summary_file_name(directory):
+    return os.path.join(directory, SUMMARY_FILE_NAME)
+
+
+def summarise_states(segments, threshold, time_range=None):
+    """
+    Parameters
+    ----------
+    segments : list ,
+        The unbroken (rows, columns) segments of states of a trajectory.
+    threshold : float ,
+        Distance under which the tip is in contact.
+    time_range : dict ,
+        The resampled time of the first and the last state (start, end), as
+        process_trajectory reports it. The duration spans from the first to
+        the end of the last resampling step, gaps included. Without it the
+        duration is estimated from the number of rows.
+
+    Returns
+    -------
+    A dictionary of the rows, duration, force/torque extrema and contact ratio of the trajectory.
+    """
+    segments = [segment for segment in segments if len(segment) > 0]
+    if not segments:
+        return {'rows': 0, 'duration': 0.0}
+    records = as_records(np.concatenate(segments), STATE_DTYPE)
+    ft = records["ft"]
+    in_contact = contact_distance(records["nodes"], records["tip"]) <= threshold
+    if time_range and 'start' in time_range:
+        duration = time_range['end'] - time_range['start'] + STATE_STEP
+    else:
+        duration = len(records) * STATE_STEP
+    summary = {'rows': len(records), 'duration': round(duration, 6)}
+    for i, name in enumerate(['force_x', 'force_y', 'torque']):
+        summary[name + '_min'] = float(ft[:, i].min())
+        summary[name + '_max'] = float(ft[:, i].max())
+    summary['contact_ratio'] = float(in_contact.mean())
+    return summary
+
+
+def write_summary(directory, rows):
+    """
+    Writes the summary rows (dictionaries keyed by SUMMARY_COLUMNS, missing
+    values are left empty) in trajectory order.
+    """
+    fl = io.StringIO(newline='')
+    writer = csv.DictWriter(fl, fieldnames=SUMMARY_COLUMNS, delimiter='\t', extrasaction='ignore')
+    writer.writeheader()
+    for row in sorted(rows, key=lambda row: int(row['trajectory'])):
+        writer.writerow(row)
+    write_text_atomically(summary_file_name(directory), fl.getvalue())
+
+
+# Numbers as numbers, empty fields as None, everything else as text
+def _value(text):
+    if text == '' or text is None:
+        return None
+    try:
+        number = float(text)
+    except ValueError:
+        return text
+    return int(number) if number.is_integer() and '.' not in text and 'e' not in text.lower() else number
+
+
+def read_summary(path):
+    if os.path.isdir(path):
+        path = summary_file_name(path)
+    with open(path, newline='') as fl:
+        return [{key: _value(value) for key, value in row.items()} for row in csv.DictReader(fl, delimiter='\t')]
+
+
+CONDITION = re.compile(r'^\s*(\w+)\s*(<=|>=|==|!=|<|>|=)\s*(.+?)\s*$')
+
+OPERATORS = {
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+    '=': lambda a, b: a == b,
+    '==': lambda a, b: a == b,
+    '!=': lambda a, b: a != b}
+
+
+def parse_conditions(where):
+    """
+    Parses conditions like "contact_ratio<0.5 and vel>=50" (joined by "and"
+    or ",") into (column, operator, value) tuples.
+
+    Raises
+    ------
+    ValueError
+        If a condition can not be parsed or names an unknown column.
+    """
+    conditions = []
+    if not where:
+        return conditions
+    for part in re.split(r',|\band\b', where):
+        if part.strip() == '':
+            continue
+        match = CONDITION.match(part)
+        if match is None:
+            raise ValueError('cannot parse the condition: ' + part.strip())
+        column, operator, value = match.groups()
+        if column not in SUMMARY_COLUMNS:
+            raise ValueError('unknown summary column: ' + column + ', use one of: ' + ", ".join(SUMMARY_COLUMNS))
+        conditions.append((column, operator, _value(value.strip('\'"'))))
+    return conditions
+
+
+def query_summary(rows, where=None, order_by=None):
+    """
+    Filters the summary rows by where and sorts them by order_by, a column
+    name, descending when prefixed with "-" (e.g. "-rows" for the longest first).
+    Rows missing a compared value never match.
+    """
+    for column, operator, value in parse_conditions(where):
+        compare = OPERATORS[operator]
+        rows = [row for row in rows if row.get(column) is not None and compare(row[column], value)]
+    if order_by:
+        descending = order_by.startswith('-')
+        column = order_by.lstrip('-')
+        if column not in SUMMARY_COLUMNS:
+            raise ValueError('unknown summary column: ' + column + ', use one of: ' + ", ".join(SUMMARY_COLUMNS))
+        present = [row for row in rows if row.get(column) is not None]
+        missing = [row for row in rows if row.get(column) is None]
+        rows = sorted(present, key=lambda row: row[column], reverse=descending) + missing
+    return rows
+
+
+# Shift the trajectory indexes of a summary, for merging partitioned runs
+def shift_summary(rows, trajectory_offset):
+    return [dict(row, trajectory=int(row['trajectory']) + trajectory_offset) for row in rows]
@@ -0,0 +1,42 @@
+import argparse
+
+# Heavy imports are deferred to run, so parsing arguments stays fast
+def add_arguments(parser):
+    parser.add_argument('-f', '--file', dest='file', type=str,
+                        required=True,
+                        help='Any part file (_k_of_n.csv) of the examples, flagged or not.')
+    parser.add_argument('-i', '--ids', dest='ids', type=str,
+                        required=True,
+                        help='The example ids to fetch, e.g. 0,5,10-20.')
+    parser.add_argument('-o', '--out', dest='out', type=str,
+                        help='Save the (batch, n, columns) array to this .npy file instead of printing it.')
+
+def run(args):
+    import numpy as np
+    from CommonUtils.ExampleReader import ExampleReader
+    from CommonUtils.TrajectoryIndex import parse_index_spec
+
+    reader = ExampleReader(args.file)
+    ids = parse_index_spec(args.ids)
+    examples = reader.fetch(ids)
+    if args.out is not None:
+        np.save(args.out, examples)
+        return
+    np.set_printoptions(linewidth=200, suppress=True)
+    print(",".join(reader.header))
+    for example_id, example in zip(ids, examples):
+        print("id " + str(example_id) + ":")
+        print(example)
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser('fetch')
+    add_arguments(parser)
+
+    args = parser.parse_args(argv)
+
+    run(args)
+    
+
+if __name__ == "__main__":
+    main()
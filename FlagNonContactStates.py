@@ -1,10 +1,7 @@
 import argparse
 
-from FlagNonContactUtils.DistanceFilter import DistanceFilter
-
-def main(argv=None):
-
-    parser = argparse.ArgumentParser('process')
+# Heavy imports are deferred to run, so parsing arguments stays fast
+def add_arguments(parser):
     parser.add_argument('-s', '--source-dir', dest='source_dir', type=str,
                         required=True,
                         help='The directory holding the state file tuples.')
@@ -12,11 +9,30 @@ def main(argv=None):
                         help='The directory where we output the filtered state file tuples.')
     parser.add_argument('-t', '--contact-distance-threshold', dest='threshold', type=float,
                         help='The distance at and beyond which the end effector is no longer considered to be in contact.')
+    parser.add_argument('-c', '--compress', dest='compress', type=str, choices=['gzip', 'zstd'],
+                        help='Compress the output files while writing them (zstd needs the zstandard package).')
+    parser.add_argument('--precision', dest='precision', type=int,
+                        help='Rewrite the values with this many significant digits and the integer columns ' +
+                             '(id, base_vel, base_acc, in_contact, trajectory) as integers (default: copy the input text).')
+    parser.add_argument('--dtype', dest='dtype', type=str, choices=['float64', 'float32'],
+                        help='Round the values to this precision, float32 also writes the integer columns as integers.')
+    parser.add_argument('--compress-threads', dest='compress_threads', type=int,
+                        help='The number of threads compressing the output (default: number of CPUs).')
 
-    args = parser.parse_args(argv)
+def run(args):
+    from FlagNonContactUtils.DistanceFilter import DistanceFilter
 
     pre = DistanceFilter(args)
     pre.flag_contacts()
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser('process')
+    add_arguments(parser)
+
+    args = parser.parse_args(argv)
+
+    run(args)
     
 
 if __name__ == "__main__":
@@ -1,9 +1,6 @@
 import os
 import sys
 import numpy as np
-import pandas as pd
-import zipfile
-import shutil
 import logging
 import csv
 
@@ -11,6 +8,15 @@ from os import listdir
 from os.path import isfile, join
 
 from FlagNonContactUtils.FileManipulationTools import read_file
+from CommonUtils.FileManipulationTools import list_state_files
+from CommonUtils.StateSchema import EXAMPLE_DTYPE, FLAGGED_EXAMPLE_HEADERS, as_records
+from CommonUtils.TrajectoryIndex import TrajectoryIndexBuilder, load_fragments, read_fragmented_rows, iter_trajectory_rows
+from CommonUtils.CompressedFiles import COMPRESSIONS, StateFileWriter, strip_compression_extension, with_compression_extension
+from CommonUtils.ContactGeometry import CONTACT_THRESHOLD, get_closest_points, calculate_distance
+from CommonUtils.RowFormat import RowFormatter
+from CommonUtils.TrajectorySummary import summary_file_name, read_summary, write_summary
+from CommonUtils.AtomicFiles import file_stamp, read_manifest, write_manifest
+from CommonUtils.ExampleReader import PART_PATTERN
 
 class DistanceFilter:
     def __init__(self, args):    
@@ -21,9 +27,25 @@ class DistanceFilter:
         if not args.out_dir == None:
             self.out_dir = args.out_dir
         # Set threshold
-        self.threshold = 0.05
+        self.threshold = CONTACT_THRESHOLD
         if not args.threshold == None:
             self.threshold = args.threshold
+        # Compression of the output files
+        self.compress = None
+        if not args.compress == None:
+            self.compress = args.compress
+        # Number of threads compressing the output
+        self.compress_threads = os.cpu_count() or 1
+        if not args.compress_threads == None:
+            self.compress_threads = args.compress_threads
+
+        # Significant digits and precision of the written values, the input text is copied by default
+        self.precision = getattr(args, 'precision', None)
+        self.dtype = getattr(args, 'dtype', None)
+        self.formatter = RowFormatter(FLAGGED_EXAMPLE_HEADERS, self.precision, self.dtype)
+
+        if self.compress is not None and self.compress not in COMPRESSIONS:
+            raise ValueError('compress has to be one of: ' + ", ".join(COMPRESSIONS))
         
         # Create out_dir if it doesn't exist
         if not os.path.exists(self.out_dir):
@@ -32,56 +54,24 @@ class DistanceFilter:
         if not os.path.exists(self.source_dir):
             raise ValueError('source directory does not exist: ' +
                              self.source_dir)
-        self.headers = [
-            "id",
-            "o_t_r_x",
-            "o_t_r_y",
-            "o_t_l_x",
-            "o_t_l_y",
-            "o_b_r_x",
-            "o_b_r_y",
-            "o_b_l_x",
-            "o_b_l_y",
-            "o_m_m_x",
-            "o_m_m_y",
-            "o_pos_x",
-            "o_pos_y",
-            "o_angle",
-            "e_pos_x",
-            "e_pos_y",
-            "e_angle",
-            "force_x",
-            "force_y",
-            "torque",
-            "base_vel",
-            "base_acc",
-            "in_contact",
-            "trajectory"]
+        self.headers = FLAGGED_EXAMPLE_HEADERS
+        self.trajectory_indexes = {}
+
+    # Load (and cache) the sidecar index of a state file, the fragments of every trajectory
+    def load_trajectory_index(self, file):
+        if file not in self.trajectory_indexes:
+            self.trajectory_indexes[file] = load_fragments(file)
+        return self.trajectory_indexes[file]
+
+    def extract_trajectory_rows(self, file, index):
+        fragments = self.load_trajectory_index(file).get(index)
+        if fragments is None:
+            return []
+        return read_fragmented_rows(file, [fragments])[0]
 
     def extract_trajectory(self, file, index):
-        
-        trajectory = np.array([])
-        header = 0
-        #read csv, and split on "," the line
-        with open(file, mode ='r') as fl: 
-            # reading the CSV file 
-            csv_file = csv.reader(fl, delimiter=",")
-
-            # displaying the contents of the CSV file 
-            for row in csv_file:
-                try:
-                    traj_index = int(float(row[-1]))
-                    row = [float(ele) for ele in row] 
-                    if traj_index == index:
-                        # Append to trajectory
-                        if len(trajectory) == 0:
-                            trajectory = np.array([row])
-                        else:
-                            trajectory = np.append(trajectory, [row], axis=0)
-
-                except:
-                    header = np.array(row)
-                
+        rows = self.extract_trajectory_rows(file, index)
+        trajectory = np.array([[float(ele) for ele in row] for row in rows])
         return trajectory
 
     def update_line(self, line, flag):
@@ -89,130 +79,166 @@ class DistanceFilter:
         lin = np.concatenate((line[:-1],[str(flag)],[line[-1]]))
         return lin
 
-    def update_file(self, file, flags):
+    def update_file(self, outf, rows, flags):
+        offset = outf.tell()
         counter = 0
-        with open(os.path.join(self.source_dir, file)) as inf, open(os.path.join(self.out_dir, "Flagged"+file), 'a', newline='') as outf:
-            reader = csv.reader(inf, delimiter=",")
-            writer = csv.writer(outf)
-            for line in reader:
-                if line[0] =='id':
-                    pass
-                else:
-                    try:
-                        line_id = int(float(line[0]))
-                        flag_id = int(flags[counter, 0])
-                        if line_id == flag_id:
-                            flag = flags[counter, 1]
-                            line = self.update_line(line, flag)
-                            writer.writerow(line)
-                            counter += 1
-                        else:
-                            pass
-                    except:
-                        break    
+        writer = csv.writer(outf)
+        for line in rows:
+            line_id = int(float(line[0]))
+            flag_id = int(flags[counter, 0])
+            if line_id != flag_id:
+                raise ValueError('Row with id ' + str(line_id) + ' does not match its flag in: ' + str(outf.path))
+            line = self.update_line(line, flags[counter, 1])
+            writer.writerow(line)
+            counter += 1
+        return offset
 
     def extract_max_traj_index(self, file):
-        max_traj_index = -1
-        with open(file, mode ='r') as fl:
-            csv_file = csv.reader(fl, delimiter=",")
-            last_row = None
-            for last_row in csv_file:
-                pass
-            try:
-                max_traj_index = int(float(last_row[-1]))
-            except:
-                max_traj_index = -1
-
-        return max_traj_index
+        index = self.load_trajectory_index(file)
+        if len(index) == 0:
+            return -1
+        return max(index)
 
     def create_dictionary(self, trajectory):
+        # Named zero-copy views of the columns
+        records = as_records(trajectory, EXAMPLE_DTYPE)
         traj_dict = {}
-        traj_dict["ind"] = trajectory[:, 0]
+        traj_dict["ind"] = records["id"]
         
-        traj_dict["obj"] = trajectory[:, 11:14]
+        traj_dict["obj"] = records["obj"]
 
-        traj_dict["tip"] = trajectory[:, 14:17]
+        traj_dict["tip"] = records["tip"]
 
-        traj_dict["ft"] = trajectory[:, 17:20]
+        traj_dict["ft"] = records["ft"]
 
-        traj_dict["nodes"] = trajectory[:, 1:11]
+        traj_dict["nodes"] = records["nodes"]
 
         return traj_dict
 
     def get_closest_points(self, np_nodes, np_tip):
-        # Find two closest points
-        np_tip = np_tip[:, :2]
-        np_nodes = np_nodes[:, :8]
-
-        # Closeness
-        np_tip = np.tile(np_tip,(1,4))
-        diff = np_nodes - np_tip
-        diff = diff.reshape((len(diff), 4, 2))
-        pow2s = np.power(diff, 2)
-
-        # No sqrt because we don't care about actual values, we just want to compare them
-        sums = np.sum(pow2s, axis=2)
-        idx = np.argpartition(sums, 2, axis=1)
-
-        bools = np.zeros(idx.shape)
-        bools[:,:2] = 1
-        
-        # Boolean indexing
-        closest_nodes = np_nodes.reshape((len(np_nodes), 4, 2))
-        bools = np.reshape(bools, (len(bools), closest_nodes.shape[1], 1))
-        bools = np.repeat(bools, 2, axis=2)
-        bools = bools > 0
-        
-        closest_nodes = closest_nodes[bools]
-        closest_nodes = closest_nodes.reshape((len(bools), 2, 2))
-
-        return closest_nodes
+        return get_closest_points(np_nodes, np_tip)
     
     def calculate_distance(self, closest_np, np_tip):
-        n_not_unit = closest_np[:, 0, :] - closest_np[:, 1, :]
-        l = np.linalg.norm(n_not_unit, axis=1, keepdims=True)
-        n = n_not_unit / l
-        
-        p = np_tip[:, :2]
-
-        a = closest_np[:, 0]
-
-        b = (a - p) - ((a - p) * n) * n
+        return calculate_distance(closest_np, np_tip)
 
-        distance = np.linalg.norm(b, axis=1)
-
-        return distance
+    # The flagged output of f, compressed as requested rather than like its input
+    def output_file_name(self, f):
+        return os.path.join(self.out_dir, with_compression_extension("Flagged"+strip_compression_extension(f), self.compress))
 
     def create_output_file(self, f):
-        with open(os.path.join(self.out_dir, "Flagged"+f), 'w', newline='') as outf:
-            writer = csv.writer(outf)
-            writer.writerow(self.headers)
-
+        outf = StateFileWriter(self.output_file_name(f), self.compress, self.compress_threads)
+        writer = csv.writer(outf)
+        writer.writerow(self.headers)
+        return outf
+
+
+    # The flagged output of f is complete and was produced from the current f with the current threshold
+    def is_up_to_date(self, f):
+        manifest = read_manifest(self.output_file_name(f))
+        if manifest is None:
+            return False
+        return (manifest.get('source') == file_stamp(os.path.join(self.source_dir, f))
+                and manifest.get('threshold') == self.threshold
+                and manifest.get('precision') == self.precision
+                and manifest.get('dtype') == self.dtype)
 
     def flag_contacts(self):
-        files = [f for f in listdir(self.source_dir) if isfile(join(self.source_dir, f))]
+        files = list_state_files(self.source_dir)
+        # Flagged and total rows of every trajectory, over all files
+        self.contact_counts = {}
 
         for f in files:
+            # Outputs committed by an earlier (or concurrent) run are kept
+            if self.is_up_to_date(f):
+                print("Skipping " + str(f) + ", its flagged output is up to date.")
+                manifest = read_manifest(self.output_file_name(f))
+                if self.counts_contacts(f):
+                    self.add_contact_counts({int(traj): counts for traj, counts in manifest.get('contact', {}).items()})
+                continue
+
             f_path = os.path.join(self.source_dir, f)
-            max_traj_index = self.extract_max_traj_index(f_path)
+            trajectory_index = self.load_trajectory_index(f_path)
             
-            self.create_output_file(f)
-
-            for index in range(max_traj_index+1):
-                trajectory = self.extract_trajectory(f_path, index)
-                
-                traj_dict = self.create_dictionary(trajectory)
-
-                closest_np = self.get_closest_points(traj_dict["nodes"], traj_dict["tip"])
-
-                distance = self.calculate_distance(closest_np, traj_dict["tip"])
-                
-                in_contact = distance<=self.threshold
+            outf = self.create_output_file(f)
+            self.file_contact_counts = {}
+            try:
+                out_index = self.flag_file(f_path, trajectory_index, outf)
+            except BaseException:
+                # A failed file leaves no partial output behind
+                outf.abort()
+                raise
+
+            outf.close()
+            out_index.write(outf.path)
+            write_manifest(outf.path, outf.lines - 1, outf.checksum(),
+                           source = file_stamp(f_path),
+                           threshold = self.threshold,
+                           precision = self.precision,
+                           dtype = self.dtype,
+                           contact = {str(traj): counts for traj, counts in self.file_contact_counts.items()})
+            if self.counts_contacts(f):
+                self.add_contact_counts(self.file_contact_counts)
+
+        self.write_summary()
+
+    # Every part file (_k_of_n) holds the states of the same trajectories,
+    # only the first part is counted so each state is counted once
+    def counts_contacts(self, f):
+        matches = list(PART_PATTERN.finditer(f))
+        return not matches or matches[-1].group(1) == '1'
+
+    def add_contact_counts(self, counts):
+        for traj, (contact, total) in counts.items():
+            current = self.contact_counts.setdefault(traj, [0, 0])
+            current[0] += contact
+            current[1] += total
+
+    # The trajectory summary of the processor, with the contact ratio of the flags
+    def write_summary(self):
+        rows = {}
+        if os.path.exists(summary_file_name(self.source_dir)):
+            rows = {row['trajectory']: row for row in read_summary(self.source_dir)}
+        for traj, (contact, total) in self.contact_counts.items():
+            row = rows.setdefault(traj, {'trajectory': traj})
+            row['contact_ratio'] = contact / total if total else None
+        if rows:
+            write_summary(self.out_dir, rows.values())
+
+    # Flag every trajectory of f_path and write it to outf, returns the index of outf
+    def flag_file(self, f_path, trajectory_index, outf):
+        out_index = TrajectoryIndexBuilder()
+
+        # One pass over the input, in file order. Every state is flagged on its own,
+        # so the fragments of shuffled files are flagged as they come.
+        entries = [entry for fragments in trajectory_index.values() for entry in fragments]
+        for entry, rows in iter_trajectory_rows(f_path, entries):
+            index = entry.trajectory
+            trajectory = np.array([[float(ele) for ele in row] for row in rows])
+            
+            traj_dict = self.create_dictionary(trajectory)
 
-                in_contact = np.reshape(in_contact, (len(in_contact), 1))
-                inds = np.reshape(traj_dict["ind"], (len(in_contact), 1))
+            closest_np = self.get_closest_points(traj_dict["nodes"], traj_dict["tip"])
 
+            distance = self.calculate_distance(closest_np, traj_dict["tip"])
+            
+            in_contact = distance<=self.threshold
+            counts = self.file_contact_counts.setdefault(index, [0, 0])
+            counts[0] += int(in_contact.sum())
+            counts[1] += len(in_contact)
+
+            in_contact = np.reshape(in_contact, (len(in_contact), 1))
+            inds = np.reshape(traj_dict["ind"], (len(in_contact), 1))
+
+            if self.formatter.compact:
+                # Reformat the parsed rows as a block, with the flag before the trajectory index
+                offset = outf.tell()
+                flagged = np.insert(trajectory, trajectory.shape[1] - 1, in_contact[:, 0], axis=1)
+                outf.write(self.formatter.format(flagged))
+            else:
                 in_contact = np.append(inds, in_contact, axis=1)
-                self.update_file(f, in_contact)
+                offset = self.update_file(outf, rows, in_contact)
+            out_index.add(index, offset, len(rows), entry.first_id)
+
+        return out_index
 
     
\ No newline at end of file
@@ -0,0 +1,29 @@
+import argparse
+
+# Heavy imports are deferred to run, so parsing arguments stays fast
+def add_arguments(parser):
+    parser.add_argument('-i', '--partition-dirs', dest='partition_dirs', type=str, nargs='+',
+                        required=True,
+                        help='The output directories of the partitions (--partition 1/N ... N/N), in order.')
+    parser.add_argument('-o', '--out-dir', dest='out_dir', type=str,
+                        required=True,
+                        help='Where to write the merged state files and state tables, with their ids and trajectories renumbered.')
+
+def run(args):
+    from CommonUtils.PartitionMerge import merge_partitions
+
+    for path in merge_partitions(args.partition_dirs, args.out_dir):
+        print("Merged " + str(path))
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser('merge')
+    add_arguments(parser)
+
+    args = parser.parse_args(argv)
+
+    run(args)
+    
+
+if __name__ == "__main__":
+    main()
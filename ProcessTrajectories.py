@@ -1,10 +1,7 @@
 import argparse
 
-from ProcessTrajectoriesUtils.TrajectoryProcessor import TrajectoryProcessor
-
-def main(argv=None):
-
-    parser = argparse.ArgumentParser('process')
+# Heavy imports (numpy, pandas, h5py) are deferred to run, so parsing arguments stays fast
+def add_arguments(parser):
     parser.add_argument('-s', '--source-dir', dest='source_dir', type=str,
                         required=True,
                         help='Directory holding the h5 or json files.')
@@ -20,13 +17,66 @@ def main(argv=None):
                         help='Should trajectories with different end-effector velocities be in the same output.')
     parser.add_argument('-a', '--mixed-acceleration', dest='mixed_acc', type=bool,
                         help='Should trajectories with different end-effector accelerations be in the same output')
+    parser.add_argument('-l', '--layout', dest='layout', type=str, choices=['parts', 'table'],
+                        help='parts writes every example into n part files, table stores every state once ' +
+                             'with an index of example windows (default: parts).')
+    parser.add_argument('-c', '--compress', dest='compress', type=str, choices=['gzip', 'zstd'],
+                        help='Compress the output files while writing them (zstd needs the zstandard package).')
+    parser.add_argument('--compress-threads', dest='compress_threads', type=int,
+                        help='The number of threads compressing the output (default: number of CPUs).')
+    parser.add_argument('--precision', dest='precision', type=int,
+                        help='Write the values with this many significant digits and the integer columns as integers ' +
+                             '(default: full float64 precision).')
+    parser.add_argument('--dtype', dest='dtype', type=str, choices=['float64', 'float32'],
+                        help='Round the values to this precision before writing them, float32 also writes ' +
+                             'the integer columns as integers (default: float64).')
+    parser.add_argument('--split', dest='split', type=str,
+                        help='Train/val/test ratios, e.g. 0.8,0.1,0.1. Each split is written to its own files.')
+    parser.add_argument('--split-by', dest='split_by', type=str, choices=['file', 'trajectory'],
+                        help='Assign trajectories to splits by a hash of the source file name or of the trajectory index (default: file).')
+    parser.add_argument('--seed', dest='seed', type=int,
+                        help='Seed of the split assignment and of the shuffling (default: 0).')
+    parser.add_argument('--shuffle-buffer', dest='shuffle_buffer', type=int,
+                        help='Shuffle examples in buffers of this many examples before writing them (default: 0, no shuffling).')
+    parser.add_argument('--max-gap', dest='max_gap', type=float,
+                        help='Trajectories are cut where consecutive resampled states are more than this many seconds apart, ' +
+                             'so no example spans a gap (default: 0.01, one resampling step).')
+    parser.add_argument('--batch-files', dest='batch_files', type=int,
+                        help='Resample and clean this many source files together in one vectorized pass, ' +
+                             'which is faster for many short recordings (default: 0, one file at a time).')
+    parser.add_argument('--json-cache', dest='json_cache', action='store_true',
+                        help='Convert every JSON recording once into a binary copy in <source-dir>/json_cache, ' +
+                             'which later runs load instead of parsing the JSON again.')
+    parser.add_argument('--contact-threshold', dest='contact_threshold', type=float,
+                        help='Only write examples with the tip in contact: the distance under which a state is in contact ' +
+                             '(the flagger uses 0.05). By default every example is written.')
+    parser.add_argument('--min-contact-steps', dest='min_contact_steps', type=int,
+                        help='How many states of an example have to be in contact (default: all of them).')
+    parser.add_argument('--partition', dest='partition', type=str,
+                        help='Only process partition k/N of the source files (by a stable hash of the file name), ' +
+                             'e.g. 2/4. Join the outputs of the partitions with: mitpush.py merge.')
+    parser.add_argument('--plan', dest='plan', action='store_true',
+                        help='Only read the metadata of the source files and print the estimated rows and sizes ' +
+                             'of every output file, the runtime and the memory of a worker. Nothing is written.')
 
 
-    args = parser.parse_args(argv)
-
+def run(args):
+    from ProcessTrajectoriesUtils.TrajectoryProcessor import TrajectoryProcessor
 
     pre = TrajectoryProcessor(args)
-    pre._process_trajectories()
+    if getattr(args, 'plan', False):
+        pre._plan_trajectories()
+    else:
+        pre._process_trajectories()
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser('process')
+    add_arguments(parser)
+
+    args = parser.parse_args(argv)
+
+    run(args)
     
 
 if __name__ == "__main__":
@@ -0,0 +1,171 @@
+import os
+import numpy as np
+
+from CommonUtils.StateSchema import EXAMPLE_HEADERS, STATE_DTYPE
+from CommonUtils.RowFormat import INTEGER_COLUMNS, FLOAT32_DIGITS
+
+# Streams of a source recording
+STREAMS = ['object_pose', 'tip_pose', 'ft_wrench']
+
+# Resampling step of the processor, in seconds
+SAMPLE_STEP = 0.01
+
+"""
+Benchmark coefficients, measured by processing MIT Push style recordings
+with ProcessTrajectories.py on a single core. Re-measure them when the
+processing pipeline changes significantly.
+"""
+# Seconds of fixed cost per source file (open, dataframes, resample setup)
+SECONDS_PER_FILE = 0.05
+# Seconds per raw sample over all streams (dataframes, resampling, cleaning)
+SECONDS_PER_RAW_ROW = 5e-6
+# Seconds per written output row (formatting and writing one row of one part file)
+SECONDS_PER_OUTPUT_ROW = 2e-5
+# Average bytes of one csv row of full precision floats
+CSV_BYTES_PER_ROW = 410.0
+# With --precision/--dtype float32: bytes of a value besides its digits (sign, point, exponent, comma)
+# and bytes of the integer columns and the line end
+COMPACT_BYTES_PER_VALUE = 3.8
+COMPACT_BYTES_OF_INTEGERS = 16.0
+# Compressed size relative to the csv
+COMPRESSION_RATIOS = {'gzip': 0.40, 'zstd': 0.41}
+# Bytes of one JSON recording per raw sample, used when only the file size is known
+JSON_BYTES_PER_RAW_ROW = 90.0
+# Resident memory of the interpreter with numpy, pandas and h5py loaded
+BASE_MEMORY = 150 * 2**20
+
+
+def read_source_metadata(source_dir, f):
+    """
+    Reads the shape and the time range of every stream without loading the data:
+    only the dataset shapes and the first and last timestamps of h5 files are read.
+    JSON files can only be sized, their sample count is estimated from the file size.
+
+    Returns
+    -------
+    metadata : dict ,
+        raw_rows: the number of samples over all streams,
+        start, end: the time range covered by all streams (None for JSON files).
+    """
+    path = os.path.join(source_dir, f)
+    if f.endswith('.h5'):
+        import h5py
+        with h5py.File(path, 'r') as h5:
+            shapes = [h5[stream].shape for stream in STREAMS]
+            starts = [float(h5[stream][0, 0]) for stream in STREAMS if h5[stream].shape[0] > 0]
+            ends = [float(h5[stream][-1, 0]) for stream in STREAMS if h5[stream].shape[0] > 0]
+        if len(starts) < len(STREAMS):
+            return {'raw_rows': sum(shape[0] for shape in shapes), 'start': 0.0, 'end': 0.0}
+        return {'raw_rows': sum(shape[0] for shape in shapes), 'start': max(starts), 'end': min(ends)}
+
+    elif f.endswith('.json'):
+        return {'raw_rows': int(os.path.getsize(path) / JSON_BYTES_PER_RAW_ROW), 'start': None, 'end': None}
+
+    raise NotImplementedError('The file: '+ str(f)+ ' is not supported! Please use files with extensions: .h5 or .json')
+
+
+# Number of resampled states left after clear_dataset trims both ends
+def estimate_states(metadata):
+    if metadata['start'] is None:
+        # Without timestamps assume the streams of a JSON recording are sampled at about 500 Hz in total
+        return int(metadata['raw_rows'] / 5)
+    return max(0, int(np.floor((metadata['end'] - metadata['start']) / SAMPLE_STEP)) - 1)
+
+
+def estimate_examples(states, number_of_steps):
+    return max(0, states - (number_of_steps - 1))
+
+
+# Significant digits written per value with the given --precision/--dtype, None for full precision
+def written_digits(precision=None, dtype=None):
+    if precision is not None:
+        return precision
+    if dtype == 'float32':
+        return FLOAT32_DIGITS
+    return None
+
+
+# Average bytes of one csv row with digits significant digits per value
+def bytes_per_row(digits=None):
+    if digits is None:
+        return CSV_BYTES_PER_ROW
+    values = len([name for name in EXAMPLE_HEADERS if name not in INTEGER_COLUMNS])
+    return values * (min(digits, 17) + COMPACT_BYTES_PER_VALUE) + COMPACT_BYTES_OF_INTEGERS
+
+
+# Output bytes of one file of rows examples in every supported format
+def estimate_bytes(rows, digits=None):
+    sizes = {'csv': rows * bytes_per_row(digits)}
+    for compress, ratio in COMPRESSION_RATIOS.items():
+        sizes['csv.' + compress] = sizes['csv'] * ratio
+    return sizes
+
+
+def estimate_table_bytes(states, examples):
+    return states * STATE_DTYPE.itemsize + examples * 16
+
+
+def estimate_seconds(metadata, output_rows):
+    return SECONDS_PER_FILE + metadata['raw_rows'] * SECONDS_PER_RAW_ROW + output_rows * SECONDS_PER_OUTPUT_ROW
+
+
+# Peak memory of a worker processing one file
+def estimate_memory(metadata, states, number_of_steps):
+    raw = metadata['raw_rows'] * 4 * 8 * 2
+    resampled = states * 3 * 4 * 8 * 2
+    written = states * (STATE_DTYPE.itemsize + number_of_steps * len(EXAMPLE_HEADERS) * 8)
+    return BASE_MEMORY + raw + resampled + written
+
+
+def _human(size):
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if abs(size) < 1024.0 or unit == 'TB':
+            return '{:.1f} {}'.format(size, unit)
+        size /= 1024.0
+
+
+def _duration(seconds):
+    if seconds < 60:
+        return '{:.1f} s'.format(seconds)
+    if seconds < 3600:
+        return '{:.1f} min'.format(seconds / 60.0)
+    return '{:.1f} h'.format(seconds / 3600.0)
+
+
+def format_plan(outputs, files, seconds, peak_memory, layout, compress, digits=None, notes=()):
+    """
+    Formats the plan as a table: one line per output file with its rows and
+    its estimated size, followed by the totals, the runtime and memory estimates
+    and notes on what the estimate does not account for.
+    """
+    lines = []
+    size_key = 'csv' if compress is None else 'csv.' + compress
+    header = '{:<60} {:>12} {:>12}'.format('output file', 'rows', 'size')
+    lines.append(header)
+    lines.append('-' * len(header))
+    total_rows = 0
+    total_bytes = 0
+    totals_by_format = {}
+    for name in sorted(outputs):
+        rows = outputs[name]['rows']
+        if layout == 'table':
+            size = outputs[name]['bytes']
+        else:
+            sizes = estimate_bytes(rows, digits)
+            size = sizes[size_key]
+            for key in sizes:
+                totals_by_format[key] = totals_by_format.get(key, 0) + sizes[key]
+        total_rows += rows
+        total_bytes += size
+        lines.append('{:<60} {:>12} {:>12}'.format(os.path.basename(name), rows, _human(size)))
+    lines.append('-' * len(header))
+    lines.append('{:<60} {:>12} {:>12}'.format('total (' + str(len(outputs)) + ' files)', total_rows, _human(total_bytes)))
+    lines.append('')
+    for key in sorted(totals_by_format):
+        lines.append('{:<30} {:>12}'.format('total as ' + key, _human(totals_by_format[key])))
+    lines.append('{:<30} {:>12}'.format('source files', files))
+    lines.append('{:<30} {:>12}'.format('estimated runtime', _duration(seconds)))
+    lines.append('{:<30} {:>12}'.format('peak memory per worker', _human(peak_memory)))
+    for note in notes:
+        lines.append('note: ' + note)
+    return '\n'.join(lines)
@@ -1,4 +1,7 @@
 import numpy as np
+import pandas as pd
+
+from CommonUtils.StateSchema import STATE_DTYPE, as_array
 
 # Based on the type of rigidbody extrapolate the corners of the object from its position and orientation
 def get_node_positions(obj_name, obj_pd):
@@ -30,8 +33,8 @@ def get_node_positions(obj_name, obj_pd):
     
     """
     
-    # Convert dataframe to numpy 
-    obj_np = obj_pd.to_numpy()
+    # Convert dataframe to numpy (the batch pipeline passes arrays)
+    obj_np = obj_pd.to_numpy() if hasattr(obj_pd, 'to_numpy') else np.asarray(obj_pd)
     cents = obj_np[:, 0:2]
     angles = obj_np[:, 2]
     # List of supported shapes
@@ -56,65 +59,49 @@ def get_node_positions(obj_name, obj_pd):
             a = 0.0675
             b = 0.0450
     
-    # t_r: top-right corner
-    # t_l: top-left corner
-    # b_r: bottom-right corner
-    # b_l: bottom-left corner
-    t_r = np.zeros((cents.shape[0],2)) + [a,b]
-    t_l = np.zeros((cents.shape[0],2)) + [-a,b]
-    b_r = np.zeros((cents.shape[0],2)) + [a,-b]
-    b_l = np.zeros((cents.shape[0],2)) + [-a,-b]
-    
-    # for all center locations rotate the corner by the corresponding angle
-    for i, angle in zip(range(cents.shape[0]), angles):        
-        t_r[i] = rotate_point(t_r[i], angle)
-        t_l[i] = rotate_point(t_l[i], angle) 
-        b_r[i] = rotate_point(b_r[i], angle)  
-        b_l[i] = rotate_point(b_l[i], angle)
-    
-    # Corners are calculated by adding the center locations to them
-    t_r = np.copy(cents) + t_r
-    t_l = np.copy(cents) + t_l
-    b_r = np.copy(cents) + b_r
-    b_l = np.copy(cents) + b_l
-    
-    # Create a single numpy collection 
-    corns_np = np.append(t_r,t_l,axis=1)
-    corns_np = np.append(corns_np,b_r,axis=1)
-    corns_np = np.append(corns_np,b_l,axis=1)
-    corns_np = np.append(corns_np,cents,axis=1)
-    
-    
-    corns_np = corns_np.reshape((corns_np.shape[0],5,2))
+    # Corners in the frame of the object:
+    # top-right, top-left, bottom-right, bottom-left
+    corners = np.array([[a, b], [-a, b], [a, -b], [-a, -b]])
+
+    # Rotate every corner by the orientation of the object, for all rows at once
+    # (a stacked matmul gives the same values as rotate_point row by row)
+    cos = np.cos(angles)
+    sin = np.sin(angles)
+    mats = np.stack((np.stack((cos, -sin), axis=-1), np.stack((sin, cos), axis=-1)), axis=-2)
+    rotated = np.matmul(mats[:, np.newaxis], corners[np.newaxis, :, :, np.newaxis])[..., 0]
+
+    # Corners are calculated by adding the center locations to them, the center is the fifth node
+    corns_np = np.empty((cents.shape[0], 5, 2))
+    corns_np[:, :4] = cents[:, np.newaxis] + rotated
+    corns_np[:, 4] = cents
+
 
     return corns_np
 
 def get_states(nodes_np, object_pd, endeffector_pd, forceTorque_pd, velocity, acceleration, traj_index):
-    # Convert dataframe to numpy 
-    object_np      = np.array([object_pd.to_numpy()])
-    endeffector_np = np.array([endeffector_pd.to_numpy()])
-    forceTorque_np = np.array([forceTorque_pd.to_numpy()])
+    """
+    Assembles the state vectors of a trajectory into a single preallocated
+    STATE_DTYPE record array, filling every field in place.
+
+    Returns
+    -------
+    states_np : np.array ,
+        (1, rows, columns) float64 view of the records, one unbroken segment.
+    """
+    if len(nodes_np.shape) == 4:
+        nodes_np = nodes_np[0]
+    # Preallocate the records and fill them in place
+    states = np.empty(len(nodes_np), dtype=STATE_DTYPE)
+    states["nodes"] = nodes_np.reshape((len(nodes_np), 10))
+    states["obj"] = object_pd.to_numpy()
+    states["tip"] = endeffector_pd.to_numpy()
+    states["ft"] = forceTorque_pd.to_numpy()
     # Broacastable scalars
-    velocity_np = np.tile(velocity, (1, object_np.shape[1], 1))
-    acceleration_np = np.tile(acceleration, (1, object_np.shape[1], 1))
-    traj_index_np = np.tile(traj_index, (1, object_np.shape[1], 1))
-
-    # Uniform obj_nps
-    if len(nodes_np.shape) == 3:
-        # Flatten into a vector
-        nodes_np = nodes_np.reshape((len(nodes_np), 10))
-        nodes_np = np.array([nodes_np])
-    elif len(nodes_np.shape) == 4:
-        nodes_np = nodes_np.reshape((len(nodes_np), nodes_np.shape[1], 10))
-
-    # Append previous values
-    states_np = np.append(nodes_np, object_np, axis=2)
-    states_np = np.append(states_np, endeffector_np, axis=2)
-    states_np = np.append(states_np, forceTorque_np, axis=2)
-    # Append scalars
-    states_np = np.append(states_np, velocity_np, axis=2)
-    states_np = np.append(states_np, acceleration_np, axis=2)
-    states_np = np.append(states_np, traj_index_np, axis=2)
+    states["base_vel"] = velocity
+    states["base_acc"] = acceleration
+    states["trajectory"] = traj_index
+
+    states_np = as_array(states)[np.newaxis]
     return states_np
 
 
@@ -128,7 +115,7 @@ def rotate_point(point, angle):
 # Resample the dataset so that measurement frequency inconsistencies are accounted for
 def sample_dataset(string_amount, obj_pd, tip_pd, ft_pd):
     # Resample and interpolate using the mean
-    # TODO : Cut the list into two consequtive timesteps are too far apart
+    # (the gaps left by dropped rows are cut by split_segments)
     obj_pd = obj_pd.resample(string_amount).mean()
     tip_pd = tip_pd.resample(string_amount).mean()
     ft_pd = ft_pd.resample(string_amount).mean()
@@ -160,13 +147,352 @@ def clear_dataset(obj_pd, tip_pd, ft_pd):
     ft_pd.drop(latest_ft , inplace=True, errors = 'ignore')
 
     # Drop nan rows
-    inds_obj = obj_pd[obj_pd.isnull().any(1)]
-    inds_tip = tip_pd[tip_pd.isnull().any(1)]
-    inds_ft  = ft_pd[ft_pd.isnull().any(1)]
+    inds_obj = obj_pd[obj_pd.isnull().any(axis=1)]
+    inds_tip = tip_pd[tip_pd.isnull().any(axis=1)]
+    inds_ft  = ft_pd[ft_pd.isnull().any(axis=1)]
 
     con_inds = list(inds_obj.index.values) + list(inds_tip.index.values) + list(inds_ft.index.values)
     obj_pd.drop(con_inds, inplace=True, errors = 'ignore')
     tip_pd.drop(con_inds, inplace=True, errors = 'ignore')
     ft_pd.drop(con_inds, inplace=True, errors = 'ignore')
 
-    return obj_pd, tip_pd, ft_pd
\ No newline at end of file
+    return obj_pd, tip_pd, ft_pd
+
+
+# Streams of a recording and whether their last column is an orientation
+SANITIZED_STREAMS = {'object_pose': True, 'tip_pose': True, 'ft_wrench': False}
+
+ANOMALIES = ['non_finite', 'unsorted', 'duplicate_timestamps', 'orientation_wraps']
+
+
+def sanitize_stream(stream_np, orientation, anomalies):
+    """
+    Cleans one (samples, 4) stream of [time, ...] rows before resampling:
+    drops rows with non-finite values, restores temporal ordering (sorting only
+    when the O(n) monotonicity check fails), collapses rows with the same
+    timestamp into their mean and unwraps the orientation column.
+    Every fix is counted into anomalies.
+    """
+    source = stream_np
+    stream_np = np.asarray(stream_np, dtype=np.float64)
+
+    finite = np.isfinite(stream_np).all(axis=1)
+    if not finite.all():
+        anomalies['non_finite'] += int(len(finite) - finite.sum())
+        stream_np = stream_np[finite]
+
+    steps = np.diff(stream_np[:, 0])
+    if (steps < 0).any():
+        anomalies['unsorted'] += int((steps < 0).sum())
+        stream_np = stream_np[np.argsort(stream_np[:, 0], kind='stable')]
+        steps = np.diff(stream_np[:, 0])
+
+    if (steps == 0).any():
+        # Rows of the same timestamp are contiguous now, average each run
+        starts = np.concatenate(([0], np.flatnonzero(steps) + 1))
+        counts = np.diff(np.append(starts, len(stream_np)))
+        anomalies['duplicate_timestamps'] += int(len(stream_np) - len(starts))
+        stream_np = np.add.reduceat(stream_np, starts, axis=0) / counts[:, np.newaxis]
+
+    if orientation and len(stream_np) > 1:
+        anomalies['orientation_wraps'] += int((np.abs(np.diff(stream_np[:, 3])) > np.pi).sum())
+        # Never unwrap the caller's array in place
+        if not stream_np.flags.writeable or (isinstance(source, np.ndarray) and np.shares_memory(stream_np, source)):
+            stream_np = stream_np.copy()
+        stream_np[:, 3] = np.unwrap(stream_np[:, 3])
+
+    return stream_np
+
+
+def sanitize_recording(trajectories_dict, anomalies=None):
+    """
+    Returns
+    -------
+    sanitized : dict ,
+        object_pose, tip_pose, ft_wrench as clean (samples, 4) np.arrays.
+    anomalies : dict ,
+        How many non-finite rows, out of order timestamps, duplicate timestamps
+        and orientation wraps were fixed, over all streams.
+    """
+    if anomalies is None:
+        anomalies = {}
+    for anomaly in ANOMALIES:
+        anomalies.setdefault(anomaly, 0)
+    sanitized = {}
+    for stream, orientation in SANITIZED_STREAMS.items():
+        sanitized[stream] = sanitize_stream(trajectories_dict[stream], orientation, anomalies)
+    return sanitized, anomalies
+
+
+# Split the states wherever consecutive timesteps are too far apart
+def split_segments(states_np, times, max_gap):
+    """
+    Parameters
+    ----------
+    states_np : np.array ,
+        (rows, columns) states of a trajectory.
+    times : np.array ,
+        datetime64 time of every state (the resampled index).
+    max_gap : np.timedelta64 ,
+        The largest time difference between consecutive states of a segment.
+
+    Returns
+    -------
+    segments : list ,
+        Zero-copy views of states_np, the unbroken segments in order.
+    """
+    if len(states_np) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(times) > max_gap) + 1
+    return np.split(states_np, breaks)
+
+
+# Create pandas dataframe from the dictionary supplied from the read 
+def create_pandas_dataframes(dict_obj):
+    """Given a dictionary object dict_obj
+
+    Parameters
+    ----------
+    dict_obj : dict ,
+        A dictionary with 3 keys: object_pose, tip_pose, ft_wrench
+        For each key, there is a collection of 4D vectors.
+
+    Raises
+    ------
+    ValueError
+        If no dict_obj is supplied to the function
+    
+    Returns
+    -------
+    obj_pd, tip_pd, ft_pd : pandas.dataframe ,
+        3 pandas DataFrames one for the object, one for tip and one for the force/torque sensor
+        Each dataframe has the time as its key/index
+
+    """
+    if dict_obj is None:
+        raise ValueError("The file supplied is none!")
+
+    try:
+        obj_pd = pd.DataFrame(dict_obj['object_pose'], columns=['time', 'x', 'y', 'orientation'])
+        tip_pd = pd.DataFrame(dict_obj['tip_pose']   , columns=['time', 'x', 'y', 'orientation'])
+        ft_pd  = pd.DataFrame(dict_obj['ft_wrench']  , columns=['time','force_x', 'force_y','torque'])
+
+        obj_pd["time"] = pd.to_datetime(obj_pd["time"], unit='s')
+        tip_pd["time"] = pd.to_datetime(tip_pd["time"], unit='s')
+        ft_pd["time"]  = pd.to_datetime(ft_pd["time"] , unit='s')
+
+        obj_pd = obj_pd.set_index('time')
+        tip_pd = tip_pd.set_index('time')
+        ft_pd  = ft_pd.set_index('time')
+        
+        return (obj_pd, tip_pd, ft_pd)
+
+    except Exception as e:
+        print("Oops!", e.__class__, "occurred.")
+        print()
+
+# Process the contents of a single file into its unbroken segments of state vectors
+def process_trajectory(trajectories_dict, props, traj_index, max_gap=0.01, anomalies=None, time_range=None):
+    # Get rid of redundant entries and ensuring temporal ordering,
+    # treat orientation jumps (counted into anomalies when it is given)
+    trajectories_dict, anomalies = sanitize_recording(trajectories_dict, anomalies)
+    # Convert to dataframe
+    obj_pd, tip_pd, ft_pd = create_pandas_dataframes(trajectories_dict)
+    # Downsample
+    obj_pd_sampled, tip_pd_sampled, ft_pd_sampled = sample_dataset('10ms', obj_pd, tip_pd, ft_pd)
+    # Drop nan values
+    obj_pd_dropped, tip_pd_dropped, ft_pd_dropped = clear_dataset(obj_pd_sampled, tip_pd_sampled, ft_pd_sampled)
+    # Get Corner Positions
+    nodes_np = get_node_positions(props['shape'], obj_pd_dropped)
+    # Get state vectors
+    states_np = get_states(
+        nodes_np = nodes_np, 
+        object_pd = obj_pd_dropped, 
+        endeffector_pd = tip_pd_dropped, 
+        forceTorque_pd = ft_pd_dropped, 
+        velocity = props['vel'], 
+        acceleration = props['acc'],
+        traj_index = traj_index)
+
+    # Cut the trajectory where clear_dataset dropped rows, so no example spans a gap
+    times = obj_pd_dropped.index.values
+    if time_range is not None and len(times) > 0:
+        # Resampled time of the first and the last state, in seconds
+        time_range['start'] = times[0].astype('datetime64[ns]').astype(np.int64) / 1e9
+        time_range['end'] = times[-1].astype('datetime64[ns]').astype(np.int64) / 1e9
+    return split_segments(states_np[0], times, np.timedelta64(int(round(max_gap * 1e9)), 'ns'))
+
+# Resample the concatenated stream of a batch: the mean of every (file, 10 ms bin)
+def _resample_batch_stream(streams, sample_ns):
+    lengths = [len(stream) for stream in streams]
+    file_ids = np.repeat(np.arange(len(streams)), lengths)
+    data = np.concatenate(streams) if sum(lengths) else np.empty((0, 4))
+    # The same conversion as create_pandas_dataframes, for the whole batch at once
+    times = pd.to_datetime(data[:, 0], unit='s').asi8
+    bins = times // sample_ns
+    if len(bins) == 0:
+        return file_ids, bins, data[:, 1:]
+
+    # Every stream is sorted by sanitize_stream, so groups are contiguous runs
+    change = np.empty(len(bins), dtype=bool)
+    change[0] = True
+    change[1:] = (bins[1:] != bins[:-1]) | (file_ids[1:] != file_ids[:-1])
+    starts = np.flatnonzero(change)
+    counts = np.diff(np.append(starts, len(bins)))
+    return file_ids[starts], bins[starts], _compensated_means(data[:, 1:], starts, counts)
+
+
+# Group means with the compensated (Kahan) summation of pandas' resample().mean(),
+# one step per position within the groups, so the values match the per-file path bit for bit
+def _compensated_means(values, starts, counts):
+    sums = np.zeros((len(starts), values.shape[1]))
+    compensation = np.zeros_like(sums)
+    for position in range(int(counts.max())):
+        groups = np.flatnonzero(counts > position)
+        y = values[starts[groups] + position] - compensation[groups]
+        t = sums[groups] + y
+        compensation[groups] = (t - sums[groups]) - y
+        sums[groups] = t
+    return sums / counts[:, np.newaxis]
+
+
+# First and last bin of every file of a resampled batch stream, empty files get an empty range
+def _file_extents(file_ids, bins, number_of_files):
+    files = np.arange(number_of_files)
+    starts = np.searchsorted(file_ids, files, 'left')
+    ends = np.searchsorted(file_ids, files, 'right')
+    empty = starts == ends
+    first = np.where(empty, np.iinfo(np.int64).max, bins[np.minimum(starts, len(bins) - 1)] if len(bins) else 0)
+    last = np.where(empty, np.iinfo(np.int64).min, bins[np.maximum(ends - 1, 0)] if len(bins) else 0)
+    return first, last
+
+
+def process_trajectories_batch(trajectories_dicts, props_list, traj_indexes, max_gap=0.01, anomalies_list=None,
+                               time_ranges=None, sample_ms=10):
+    """
+    Processes the recordings of many files in one set of vectorized passes,
+    to amortize the fixed per-file cost of short recordings. The raw streams
+    are concatenated with the index of their file, resampled by averaging every
+    (file, 10 ms bin), trimmed and cleaned like clear_dataset (only the bins
+    present in all three streams, strictly inside the common time range of the
+    file), turned into corners and states for the whole batch and finally
+    split into the unbroken segments of every file.
+
+    Parameters
+    ----------
+    trajectories_dicts : list ,
+        The recordings, as returned by read_file.
+    props_list : list ,
+        The properties of every recording (collect_trajectory_properties).
+    traj_indexes : list ,
+        The trajectory index of every recording.
+    anomalies_list : list ,
+        Optional dictionaries the sanitization counters of every recording are added to.
+    time_ranges : list ,
+        Optional dictionaries that receive the resampled time of the first and
+        the last state of every recording (start, end), like process_trajectory.
+
+    Returns
+    -------
+    processed : list ,
+        For every recording, the list of its unbroken segments (zero-copy
+        views of one states array), as process_trajectory returns them.
+    """
+    number_of_files = len(trajectories_dicts)
+    if anomalies_list is None:
+        anomalies_list = [{} for _ in range(number_of_files)]
+    sanitized = [sanitize_recording(trajectories_dict, anomalies)[0]
+                 for trajectories_dict, anomalies in zip(trajectories_dicts, anomalies_list)]
+
+    sample_ns = int(sample_ms) * 1000000
+    resampled = [_resample_batch_stream([recording[stream] for recording in sanitized], sample_ns)
+                 for stream in SANITIZED_STREAMS]
+
+    # Common time range of every file, as clear_dataset trims it
+    extents = [_file_extents(file_ids, bins, number_of_files) for file_ids, bins, _ in resampled]
+    latest_start = np.max([first for first, _ in extents], axis=0)
+    earliest_end = np.min([last for _, last in extents], axis=0)
+
+    # Bins present in all three streams: intersect (file, bin) keys
+    all_bins = np.concatenate([bins for _, bins, _ in resampled])
+    if len(all_bins) == 0:
+        return [[] for _ in range(number_of_files)]
+    lowest = int(all_bins.min())
+    span = int(all_bins.max()) - lowest + 1
+    if span * number_of_files >= 2**62:
+        raise ValueError('the recordings of the batch span too long a time range, use a smaller batch')
+    keys = [file_ids * span + (bins - lowest) for file_ids, bins, _ in resampled]
+    common, obj_ind, tip_ind = np.intersect1d(keys[0], keys[1], assume_unique=True, return_indices=True)
+    common, common_ind, ft_ind = np.intersect1d(common, keys[2], assume_unique=True, return_indices=True)
+    obj_ind = obj_ind[common_ind]
+    tip_ind = tip_ind[common_ind]
+
+    file_ids = common // span
+    bins = common % span + lowest
+    inside = (bins > latest_start[file_ids]) & (bins < earliest_end[file_ids])
+    file_ids = file_ids[inside]
+    bins = bins[inside]
+    obj_np = resampled[0][2][obj_ind[inside]]
+    tip_np = resampled[1][2][tip_ind[inside]]
+    ft_np = resampled[2][2][ft_ind[inside]]
+
+    # Corners and states of the whole batch
+    shapes = np.array([props['shape'] for props in props_list])
+    nodes_np = np.empty((len(obj_np), 5, 2))
+    for shape in np.unique(shapes):
+        rows = shapes[file_ids] == shape
+        nodes_np[rows] = get_node_positions(shape, obj_np[rows])
+
+    states = np.empty(len(obj_np), dtype=STATE_DTYPE)
+    states["nodes"] = nodes_np.reshape((len(nodes_np), 10))
+    states["obj"] = obj_np
+    states["tip"] = tip_np
+    states["ft"] = ft_np
+    states["base_vel"] = np.array([props['vel'] for props in props_list], dtype=np.float64)[file_ids]
+    states["base_acc"] = np.array([props['acc'] for props in props_list], dtype=np.float64)[file_ids]
+    states["trajectory"] = np.asarray(traj_indexes, dtype=np.float64)[file_ids]
+    states_np = as_array(states)
+
+    if time_ranges is not None and len(bins) > 0:
+        # Resampled times (bin starts, as the pandas index) of the first and last state of every file
+        firsts, lasts = _file_extents(file_ids, bins, number_of_files)
+        for file_index, time_range in enumerate(time_ranges):
+            if firsts[file_index] <= lasts[file_index]:
+                time_range['start'] = int(firsts[file_index]) * sample_ns / 1e9
+                time_range['end'] = int(lasts[file_index]) * sample_ns / 1e9
+
+    # Cut at file boundaries and at time gaps, then hand the segments back to their files
+    breaks = np.flatnonzero((np.diff(file_ids) != 0) | (np.diff(bins) * sample_ns > max_gap * 1e9)) + 1
+    segments = np.split(states_np, breaks) if len(states_np) else []
+    segment_files = file_ids[np.concatenate(([0], breaks))] if len(states_np) else []
+    processed = [[] for _ in range(number_of_files)]
+    for segment, file_index in zip(segments, segment_files):
+        processed[file_index].append(segment)
+    return processed
+
+
+# Consecutive states that make up the examples of an unbroken segment
+def create_example_windows(traj, number_of_steps):
+    """
+    Lets assume that we have the following indeces in traj:
+    | 1 2 3 4 5 6 7 |
+    and number_of_steps = 2, then the windows are:
+    [| 1 2 |, | 2 3 |, | 3 4 |, | 4 5 |, | 5 6 |, | 6 7 |]
+
+    Raises
+    ------
+    ValueError
+        If number_of_steps is not 2, 3, or 4
+
+    Returns
+    -------
+    windows : np.array ,
+        (examples, number_of_steps, columns) zero-copy view of traj.
+    """
+    if number_of_steps not in [2, 3, 4]:
+        raise ValueError("number_of_steps has to be either 2, 3, or 4!!! Value you supplied was: "+ str(number_of_steps))
+
+    if len(traj) < number_of_steps:
+        return np.empty((0, number_of_steps, traj.shape[1]), dtype=traj.dtype)
+    windows = np.lib.stride_tricks.sliding_window_view(traj, number_of_steps, axis=0)
+    return np.swapaxes(windows, 1, 2)
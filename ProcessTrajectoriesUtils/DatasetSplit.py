@@ -0,0 +1,57 @@
+import hashlib
+
+# Names of the splits, in the order their ratios are given
+SPLIT_NAMES = ["train", "val", "test"]
+
+
+# Parse "0.8,0.1,0.1" into normalised ratios for train/val(/test)
+def parse_split_ratios(spec):
+    ratios = [float(ele) for ele in str(spec).split(',')]
+    if not 2 <= len(ratios) <= len(SPLIT_NAMES) or any(ratio < 0 for ratio in ratios) or sum(ratios) <= 0:
+        raise ValueError('split has to be 2 or 3 non-negative ratios like 0.8,0.1,0.1, got: ' + str(spec))
+    total = sum(ratios)
+    return [ratio / total for ratio in ratios]
+
+
+def assign_split(key, ratios, seed=0):
+    """
+    Deterministically assign a trajectory to a split.
+    The key (trajectory index or source file name) and the seed are hashed
+    into a uniform number in [0, 1), which picks the split by the cumulative ratios,
+    so the same trajectory always lands in the same split for a given seed.
+    """
+    digest = hashlib.sha1((str(seed) + ':' + str(key)).encode()).hexdigest()
+    value = int(digest[:15], 16) / float(16**15)
+    cumulative = 0.0
+    for name, ratio in zip(SPLIT_NAMES, ratios):
+        cumulative += ratio
+        if value < cumulative:
+            return name
+    return SPLIT_NAMES[len(ratios) - 1]
+
+
+# The base file name of the output files of a split
+def split_base_name(base_fileName, split):
+    if split is None:
+        return base_fileName
+    return str(base_fileName) + "_" + split
+
+
+# Parse "k/N" into the 1-based partition k of N
+def parse_partition(spec):
+    try:
+        k, n = [int(ele) for ele in str(spec).split('/')]
+    except ValueError:
+        raise ValueError('partition has to be k/N like 2/4, got: ' + str(spec))
+    if n < 1 or not 1 <= k <= n:
+        raise ValueError('partition has to be k/N with 1 <= k <= N, got: ' + str(spec))
+    return k, n
+
+
+def assign_partition(f, partitions):
+    """
+    The 1-based partition of a source file, from a stable hash of its name,
+    so every machine of a partitioned run agrees on it without coordination.
+    """
+    digest = hashlib.sha1(str(f).encode()).hexdigest()
+    return int(digest[:15], 16) % partitions + 1
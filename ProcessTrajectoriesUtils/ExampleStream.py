@@ -0,0 +1,123 @@
+import os
+import numpy as np
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from ProcessTrajectoriesUtils.FileManipulationTools import read_file, collect_trajectory_properties
+from ProcessTrajectoriesUtils.DataManipulationTools import process_trajectory, create_example_windows
+from CommonUtils.StateSchema import STATE_HEADERS
+
+
+# Read, process and window a single source file, run inside the worker processes
+def _load_windows(path, shape, traj_index, number_of_steps):
+    source_dir, f = os.path.split(path)
+    dict_obj = read_file(source_dir, f)
+    try:
+        properties = collect_trajectory_properties(f, shape)
+        processed_nps = process_trajectory(dict_obj, properties, traj_index)
+        if len(processed_nps) == 0:
+            # No overlapping states in the file, no examples
+            return np.empty((0, number_of_steps, len(STATE_HEADERS)))
+        windows = [create_example_windows(traj, number_of_steps) for traj in processed_nps]
+        return np.concatenate(windows, axis=0)
+    finally:
+        if hasattr(dict_obj, 'close'):
+            dict_obj.close()
+
+
+class ExampleStream:
+    """
+    Iterable dataset of the examples TrajectoryProcessor would write, computed on the fly.
+
+    Every item is a (batch_size, number_of_steps, columns) float64 array, where
+    [:, k] holds the rows of the _{k+1}_of_{number_of_steps} part file: the example
+    id followed by the state (see CommonUtils.StateSchema.EXAMPLE_HEADERS).
+    The last batch may be smaller. Ids and trajectory indices are assigned in the
+    same order as TrajectoryProcessor with mixed velocities and accelerations.
+
+    Parameters
+    ----------
+    source : str or list ,
+        A directory holding the h5 or json files, or a list of file paths.
+    number_of_steps : int ,
+        The number of consecutive states in one example (2, 3, or 4).
+    batch_size : int ,
+        The number of examples in one batch.
+    shape : str ,
+        The pushed object, by default the name of the directory holding the files.
+    workers : int ,
+        The number of processes reading the files, 0 processes them in the caller.
+    prefetch : int ,
+        How many files are processed ahead of the consumer, per worker.
+    """
+
+    def __init__(self, source, number_of_steps=2, batch_size=256, shape=None, workers=0, prefetch=2):
+        if isinstance(source, str):
+            if not os.path.exists(source):
+                raise ValueError('source directory does not exist: ' + source)
+            self.files = [os.path.join(source, f) for f in os.listdir(source)
+                          if os.path.isfile(os.path.join(source, f))]
+            if shape is None:
+                shape = os.path.split(os.path.normpath(source))[1]
+        else:
+            self.files = list(source)
+            if shape is None and len(self.files) > 0:
+                shape = os.path.split(os.path.dirname(os.path.abspath(self.files[0])))[1]
+
+        if batch_size < 1:
+            raise ValueError('batch_size has to be positive: ' + str(batch_size))
+
+        self.number_of_steps = number_of_steps
+        self.batch_size = batch_size
+        self.shape = shape
+        self.workers = workers
+        self.prefetch = prefetch
+
+    # Windows of every file, in file order
+    def _iter_windows(self):
+        if self.workers <= 0:
+            for traj_index, path in enumerate(self.files):
+                yield _load_windows(path, self.shape, traj_index, self.number_of_steps)
+            return
+
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            pending = deque()
+            tasks = iter(enumerate(self.files))
+            for traj_index, path in tasks:
+                pending.append(executor.submit(_load_windows, path, self.shape, traj_index, self.number_of_steps))
+                # Keep a bounded number of files in flight
+                while len(pending) >= self.workers * (self.prefetch + 1):
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def __iter__(self):
+        cr_eg_index = 0
+        buffered = []
+        buffered_len = 0
+        for windows in self._iter_windows():
+            if len(windows) == 0:
+                continue
+            # Prepend the example id to every state of the example
+            ids = np.arange(cr_eg_index, cr_eg_index + len(windows), dtype=np.float64)
+            examples = np.empty((len(windows), self.number_of_steps, windows.shape[2] + 1))
+            examples[:, :, 0] = ids[:, np.newaxis]
+            examples[:, :, 1:] = windows
+            cr_eg_index += len(windows)
+
+            buffered.append(examples)
+            buffered_len += len(examples)
+            while buffered_len >= self.batch_size:
+                batch = np.concatenate(buffered, axis=0)
+                yield batch[:self.batch_size]
+                buffered = [batch[self.batch_size:]]
+                buffered_len = len(buffered[0])
+
+        if buffered_len > 0:
+            yield np.concatenate(buffered, axis=0)
+
+
+# Lazily yield batches of examples, see ExampleStream
+def stream_examples(source, number_of_steps=2, batch_size=256, shape=None, workers=0, prefetch=2):
+    return iter(ExampleStream(source, number_of_steps, batch_size, shape, workers, prefetch))
@@ -0,0 +1,118 @@
+import os
+import csv
+import zlib
+import numpy as np
+
+from CommonUtils.TrajectoryIndex import TrajectoryIndexBuilder
+from CommonUtils.RunningStatistics import RunningStatistics
+from CommonUtils.StateSchema import EXAMPLE_HEADERS
+from CommonUtils.CompressedFiles import StateFileWriter, compression_of
+from CommonUtils.AtomicFiles import write_manifest
+from CommonUtils.RowFormat import RowFormatter
+
+
+class ExampleWriter:
+    """
+    Writes the examples of one group of part files (_1_of_n ... _n_of_n).
+
+    Row k of every part file belongs to the same example. With a shuffle
+    buffer, examples are collected until the buffer is full and then written
+    in a random order, the same permutation being applied to all part files,
+    so files can be streamed sequentially by training without a global shuffle.
+    Alongside the data, the writer keeps the trajectory index (unshuffled
+    output only, the readers index the fragments of shuffled files on first
+    use) and the column statistics of every part file. The part files stay open until
+    close and are compressed according to their extension, on executor.
+    They are written under temporary names and only replace the output files
+    on close, followed by the sidecars and, last, the manifests.
+    """
+
+    def __init__(self, names, shuffle_buffer=0, seed=0, executor=None, formatter=None):
+        self.names = list(names)
+        # Formats blocks of rows into text, repr of every value by default
+        self.formatter = formatter if formatter is not None else RowFormatter(EXAMPLE_HEADERS)
+        self.shuffle_buffer = shuffle_buffer
+        # Seeded by the file name, so reruns write the same order
+        self.rng = np.random.default_rng([seed, zlib.crc32(self.names[0].encode())])
+        self.indexes = [TrajectoryIndexBuilder() for _ in self.names]
+        self.statistics = [RunningStatistics(EXAMPLE_HEADERS) for _ in self.names]
+        self.buffer = []
+        self.buffered = 0
+        self.executor = executor
+        self.files = None
+
+    # Open the part files and write their headers
+    def _open(self):
+        if self.files is None:
+            self.files = [StateFileWriter(name, compression_of(name), executor=self.executor)
+                          for name in self.names]
+            for file in self.files:
+                csv.writer(file).writerow(EXAMPLE_HEADERS)
+        return self.files
+
+    def write(self, ids, windows, traj_index):
+        """
+        Parameters
+        ----------
+        ids : np.array ,
+            The example id of every window.
+        windows : np.array ,
+            (examples, number_of_steps, columns) states of the examples.
+        traj_index : int ,
+            The trajectory the examples come from.
+        """
+        if len(windows) == 0:
+            return
+        if self.shuffle_buffer <= 0:
+            self._write_block(ids, windows, traj_index)
+            return
+
+        self.buffer.append((ids, np.array(windows)))
+        self.buffered += len(windows)
+        if self.buffered >= self.shuffle_buffer:
+            self.flush()
+
+    # Write everything in the shuffle buffer, in a random order
+    def flush(self):
+        if self.buffered == 0:
+            return
+        ids = np.concatenate([block[0] for block in self.buffer])
+        windows = np.concatenate([block[1] for block in self.buffer])
+        order = self.rng.permutation(len(ids))
+        self.buffer = []
+        self.buffered = 0
+        self._write_block(ids[order], windows[order], None)
+
+    def _write_block(self, ids, windows, traj_index):
+        for part, file in enumerate(self._open()):
+            # The id makes each example in the dataset uniquely indexed
+            rows = np.column_stack((ids, windows[:, part]))
+            # Record where this trajectory starts in the file for the sidecar index
+            if traj_index is not None:
+                self.indexes[part].add(
+                    trajectory = traj_index,
+                    offset = file.tell(),
+                    rows = len(rows),
+                    first_id = ids[0])
+            # Accumulate the normalisation statistics of the file while writing it
+            self.statistics[part].update(rows)
+            file.write(self.formatter.format(rows))
+
+    # Flush the buffer, commit every part file and write its sidecars
+    def close(self):
+        self.flush()
+        # Files without any example still get their header
+        files = self._open()
+        for file in files:
+            file.close()
+        for part, name in enumerate(self.names):
+            if self.shuffle_buffer <= 0:
+                self.indexes[part].write(name)
+            self.statistics[part].write(name)
+            write_manifest(name, files[part].lines - 1, files[part].checksum())
+
+    # Discard everything written, the previous output files stay as they were
+    def abort(self):
+        if self.files is not None:
+            for file in self.files:
+                file.abort()
@@ -1,13 +1,17 @@
-import h5py
 import sys
 import os
 import csv
 import numpy as np
 
-def read_file(source_dir, f):
+from CommonUtils.CompressedFiles import with_compression_extension
+from ProcessTrajectoriesUtils.JsonSources import load_json_recording
+
+# With json_cache, JSON recordings are converted once into a binary cache (see JsonSources)
+def read_file(source_dir, f, json_cache=False):
     dict_obj = {}
     if f.endswith('.h5'):
         #print(str(f)+' is an .h5 file!')
+        import h5py
         try:
             dict_obj = h5py.File(os.path.join(source_dir,f), "r")
 
@@ -18,8 +22,7 @@ def read_file(source_dir, f):
     elif f.endswith('.json'):
         #print(str(f)+' is an .json file!')
         try:
-            with open(os.path.join(source_dir,f)) as fl:
-                dict_obj = json.load(fl)
+            dict_obj = load_json_recording(source_dir, f, json_cache)
         except Exception as e:
             print("Oops!", e.__class__, "occurred.")
             print()
@@ -28,43 +31,8 @@ def read_file(source_dir, f):
 
     return dict_obj
 
-# Creating the output files, and initialising the headers on the first rows
-def output_file_creation(name):
-    file_names = []
-    headers = [
-        "o_t_r_x",
-        "o_t_r_y",
-        "o_t_l_x",
-        "o_t_l_y",
-        "o_b_r_x",
-        "o_b_r_y",
-        "o_b_l_x",
-        "o_b_l_y",
-        "o_m_m_x",
-        "o_m_m_y",
-        "o_pos_x",
-        "o_pos_y",
-        "o_angle",
-        "e_pos_x",
-        "e_pos_y",
-        "e_angle",
-        "force_x",
-        "force_y",
-        "torque",
-        "base_vel",
-        "base_acc",
-        "trajectory"]
-    # Add name to the list file names
-    file_names = file_names + [name]
-    # Open file and write header  
-    with open(name, 'w', newline='') as file:
-        csv_writer = csv.writer(file)
-        csv_writer.writerow(["id"] + headers)
-    
-    return file_names
-
-# Returning the correct file name, used in output_file_creation and _create_examples_and_write_file 
-def create_name_based_on_mixing(part_index, number_of_parts, base_fileName, out_dir, shape, vel = None, acc = None):
+# Returning the correct file name, used in _setup_output and _create_examples_and_write_file 
+def create_name_based_on_mixing(part_index, number_of_parts, base_fileName, out_dir, shape, vel = None, acc = None, compress = None):
 
     if vel is None and acc is None:
         name = str(base_fileName) + "_" + shape + "_" + str(part_index) + "_of_" + str(number_of_parts)+".csv"
@@ -78,6 +46,15 @@ def create_name_based_on_mixing(part_index, number_of_parts, base_fileName, out_
     elif vel is not None and acc is not None:
         name = str(base_fileName) + "_" + shape + "_" +str(part_index) + "_of_" + str(number_of_parts) +"_vel="+str(vel)+"_acc="+str(acc)+".csv"
     
+    return os.path.join(out_dir, with_compression_extension(name, compress))
+
+# Returning the name of the state table of the compact layout, without its suffixes
+def create_table_name_based_on_mixing(base_fileName, out_dir, shape, vel = None, acc = None):
+    name = str(base_fileName) + "_" + shape
+    if vel is not None:
+        name = name + "_vel=" + str(vel)
+    if acc is not None:
+        name = name + "_acc=" + str(acc)
     return os.path.join(out_dir, name)
 
 # Collect the properties of the files by extracting parameters of the trajectory from the name
@@ -93,7 +70,7 @@ def collect_trajectory_properties(f, shape):
     properties['acc'] = acc
 
     t_ind = f.find('_t=') + 3
-    ang = float(f[t_ind:f.find('.h5')])
+    ang = float(os.path.splitext(f)[0][t_ind:])
     properties['push_angle'] = ang * 180 / np.pi
 
     i_ind = f.find('_i=') + 3
@@ -116,26 +93,28 @@ def collect_trajectory_properties(f, shape):
 # For example if mixing_vel is True, 
 # then the output files will contain example tuples 
 # from trajectories with different velocities.
-def _setup_output(base_fileName, number_of_parts, out_dir, shape, mixed_vel, mixed_acc):
+def _setup_output(base_fileName, number_of_parts, out_dir, shape, mixed_vel, mixed_acc, compress = None):
+    file_names = []
     # Possible velocities and accelerations
     possible_vels = [10, 20, 50, 75, 100, 150, 200, 300, 400, 500] 
     possible_accs = [0, 0.1, 0.2, 0.5, 0.75, 1, 1.5, 2, 2.5]
 
 
     if mixed_vel and mixed_acc:
-        # Set up file names and the headers
+        # Set up file names, the files and their headers are written by ExampleWriter
         for i in range(1, number_of_parts+1):
             name = create_name_based_on_mixing(
                 part_index = i,
                 number_of_parts = number_of_parts,
                 base_fileName = base_fileName,
                 out_dir = out_dir,
-                shape = shape)
+                shape = shape,
+                compress = compress)
 
-            output_file_creation(name)
+            file_names += [name]
 
     elif not mixed_vel and mixed_acc:
-        # Set up file names and the headers
+        # Set up file names, the files and their headers are written by ExampleWriter
         for i in range(1, number_of_parts+1):
             for vel in possible_vels:
                 name = create_name_based_on_mixing(
@@ -144,12 +123,13 @@ def _setup_output(base_fileName, number_of_parts, out_dir, shape, mixed_vel, mix
                     base_fileName = base_fileName,
                     out_dir = out_dir,
                     shape = shape,
-                    vel = vel)
+                    vel = vel,
+                    compress = compress)
                     
-                output_file_creation(name)
+                file_names += [name]
     
     elif mixed_vel and not mixed_acc:
-        # Set up file names and the headers
+        # Set up file names, the files and their headers are written by ExampleWriter
         for i in range(1, number_of_parts+1):
             for acc in possible_accs:
                 name = create_name_based_on_mixing(
@@ -158,12 +138,13 @@ def _setup_output(base_fileName, number_of_parts, out_dir, shape, mixed_vel, mix
                     base_fileName = base_fileName,
                     out_dir = out_dir,
                     shape = shape,
-                    acc = acc)
+                    acc = acc,
+                    compress = compress)
 
-                output_file_creation(name)
+                file_names += [name]
     
     elif not mixed_vel and not mixed_acc:
-        # Set up file names and the headers
+        # Set up file names, the files and their headers are written by ExampleWriter
         for i in range(1, number_of_parts+1):
             for acc in possible_accs:
                 for vel in possible_vels:
@@ -174,8 +155,9 @@ def _setup_output(base_fileName, number_of_parts, out_dir, shape, mixed_vel, mix
                         out_dir = out_dir,
                         shape = shape,
                         vel = vel,
-                        acc = acc)
+                        acc = acc,
+                        compress = compress)
 
-                    output_file_creation(name)
+                    file_names += [name]
 
-    
\ No newline at end of file
+    return file_names
@@ -0,0 +1,88 @@
+import os
+import json
+import numpy as np
+
+from CommonUtils.AtomicFiles import temporary_file_name
+
+# Streams of a recording, each a list of [time, x, y, angle] (or [time, fx, fy, torque]) samples
+STREAMS = ['object_pose', 'tip_pose', 'ft_wrench']
+
+# Binary copies of JSON recordings live in this directory of the source directory,
+# which the processor does not list as a source
+CACHE_DIR = 'json_cache'
+
+
+# orjson parses several times faster than json and is used when it is installed
+def _loads(data):
+    try:
+        import orjson
+    except ImportError:
+        return json.loads(data)
+    return orjson.loads(data)
+
+
+def parse_json_recording(path):
+    """
+    Parses a JSON recording straight into float64 arrays.
+
+    Returns
+    -------
+    dict_obj : dict ,
+        object_pose, tip_pose, ft_wrench: (samples, 4) np.arrays, like the datasets of an h5 file.
+    """
+    with open(path, 'rb') as fl:
+        recording = _loads(fl.read())
+    dict_obj = {}
+    for stream in STREAMS:
+        dict_obj[stream] = np.asarray(recording[stream], dtype=np.float64).reshape(-1, 4)
+    return dict_obj
+
+
+def cache_file_name(source_dir, f):
+    return os.path.join(source_dir, CACHE_DIR, f + '.npz')
+
+
+def _source_stamp(path):
+    stat = os.stat(path)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+# The cached arrays of a recording, None if there is no cache or the recording changed since
+def read_cache(source_dir, f):
+    name = cache_file_name(source_dir, f)
+    if not os.path.exists(name):
+        return None
+    with np.load(name) as cache:
+        if not np.array_equal(cache['source_stamp'], _source_stamp(os.path.join(source_dir, f))):
+            return None
+        return {stream: cache[stream] for stream in STREAMS}
+
+
+def write_cache(source_dir, f, dict_obj):
+    name = cache_file_name(source_dir, f)
+    os.makedirs(os.path.dirname(name), exist_ok=True)
+    # Written aside and renamed, like every other output (np.savez needs a seekable file)
+    tmp_name = temporary_file_name(name)
+    try:
+        with open(tmp_name, 'wb') as fl:
+            np.savez(fl, source_stamp=_source_stamp(os.path.join(source_dir, f)), **dict_obj)
+        os.replace(tmp_name, name)
+    finally:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+
+
+def load_json_recording(source_dir, f, cache=False):
+    """
+    Loads a JSON recording. With cache, the parsed arrays are stored once in
+    <source_dir>/json_cache/<f>.npz and later runs load that instead, as long
+    as the size and modification time of the recording are unchanged.
+    """
+    if cache:
+        dict_obj = read_cache(source_dir, f)
+        if dict_obj is not None:
+            return dict_obj
+    dict_obj = parse_json_recording(os.path.join(source_dir, f))
+    if cache:
+        write_cache(source_dir, f, dict_obj)
+    return dict_obj
@@ -1,25 +1,34 @@
 import os
 import sys
 import numpy as np
-import h5py
-import pandas as pd
-import zipfile
-import shutil
 import logging
 import csv
 
+from concurrent.futures import ThreadPoolExecutor
 from os import listdir
 from os.path import isfile, join
 
-from ProcessTrajectoriesUtils.FileManipulationTools import read_file, create_name_based_on_mixing, collect_trajectory_properties, _setup_output
-from ProcessTrajectoriesUtils.DataManipulationTools import get_node_positions, get_states, sample_dataset, clear_dataset
+from ProcessTrajectoriesUtils.FileManipulationTools import read_file, create_name_based_on_mixing, create_table_name_based_on_mixing, collect_trajectory_properties, _setup_output
+from ProcessTrajectoriesUtils.DataManipulationTools import create_pandas_dataframes, process_trajectory, process_trajectories_batch, create_example_windows
+from ProcessTrajectoriesUtils.ExampleWriter import ExampleWriter
+from CommonUtils.CompressedFiles import COMPRESSIONS
+from CommonUtils.StateTable import StateTableWriter
+from ProcessTrajectoriesUtils.DatasetSplit import SPLIT_NAMES, parse_split_ratios, assign_split, split_base_name, parse_partition, assign_partition
+from ProcessTrajectoriesUtils import CapacityPlanner
+from CommonUtils.ContactGeometry import CONTACT_THRESHOLD, contact_distance, contact_windows
+from CommonUtils.TrajectorySummary import summarise_states, write_summary
+from CommonUtils.StateSchema import STATE_DTYPE, EXAMPLE_HEADERS, as_records
+from CommonUtils.RowFormat import RowFormatter
 
 
 class TrajectoryProcessor:
     
     def __init__(self, args):    
+        # Only estimate the output, nothing is written in plan mode
+        self.plan = getattr(args, 'plan', False) or False
         # Setup logging
-        self.setup_logging(args)
+        if not self.plan:
+            self.setup_logging(args)
 
         # Set source_dir
         self.source_dir = args.source_dir
@@ -43,9 +52,84 @@ class TrajectoryProcessor:
         self.mixed_acc = True
         if not args.mixed_acc == None:
             self.mixed_acc = args.mixed_acc
+        # Train/val/test ratios, if omitted everything goes into one set of files
+        self.split_ratios = None
+        if not args.split == None:
+            self.split_ratios = parse_split_ratios(args.split)
+        # Assign trajectories to splits by source file name or by trajectory index
+        self.split_by = "file"
+        if not args.split_by == None:
+            self.split_by = args.split_by
+        # Seed of the split assignment and of the shuffling
+        self.seed = 0
+        if not args.seed == None:
+            self.seed = args.seed
+        # Number of examples shuffled together before they are written, 0 keeps the order
+        self.shuffle_buffer = 0
+        if not args.shuffle_buffer == None:
+            self.shuffle_buffer = args.shuffle_buffer
+
+        # Only process the source files of partition k of N, see MergePartitions.py
+        self.partition = None
+        if getattr(args, 'partition', None) is not None:
+            self.partition = parse_partition(args.partition)
+
+        # Compression of the output files
+        self.compress = None
+        if not args.compress == None:
+            self.compress = args.compress
+        # Number of threads compressing the output
+        self.compress_threads = os.cpu_count() or 1
+        if not args.compress_threads == None:
+            self.compress_threads = args.compress_threads
+
+        # Largest time difference (in seconds) between consecutive states of an unbroken segment
+        self.max_gap = 0.01
+        if getattr(args, 'max_gap', None) is not None:
+            self.max_gap = args.max_gap
+
+        # Number of source files resampled and cleaned together, 0 processes them one at a time
+        self.batch_files = 0
+        if getattr(args, 'batch_files', None) is not None:
+            self.batch_files = max(args.batch_files, 0)
+
+        # Keep a binary copy of every JSON recording for later runs
+        self.json_cache = getattr(args, 'json_cache', False) or False
+
+        # Significant digits and precision of the written values, full float64 repr by default
+        self.precision = getattr(args, 'precision', None)
+        self.dtype = getattr(args, 'dtype', None)
+        self.formatter = RowFormatter(EXAMPLE_HEADERS, self.precision, self.dtype)
+
+        # Output layout: n part files, or a state table with a window index
+        self.layout = "parts"
+        if not args.layout == None:
+            self.layout = args.layout
+
+        # Only keep examples with the tip in contact: distance threshold, None keeps every example
+        self.contact_threshold = getattr(args, 'contact_threshold', None)
+        # How many states of an example have to be in contact (default: all of them)
+        self.min_contact_steps = self.number_of_steps
+        if getattr(args, 'min_contact_steps', None) is not None:
+            self.min_contact_steps = args.min_contact_steps
+
+        if self.min_contact_steps < 1 or self.min_contact_steps > self.number_of_steps:
+            raise ValueError('min_contact_steps has to be between 1 and number_of_steps: ' + str(self.min_contact_steps))
+        if self.layout not in ["parts", "table"]:
+            raise ValueError('layout has to be either parts or table: ' + str(self.layout))
+        if self.layout == "table" and self.compress is not None:
+            raise ValueError('compression only applies to the parts layout')
+        if self.layout == "table" and self.formatter.compact:
+            raise ValueError('precision and dtype only apply to the parts layout')
+        if self.compress is not None and self.compress not in COMPRESSIONS:
+            raise ValueError('compress has to be one of: ' + ", ".join(COMPRESSIONS))
+        if self.split_by not in ["file", "trajectory"]:
+            raise ValueError('split_by has to be either file or trajectory: ' + str(self.split_by))
+        if self.partition is not None and self.split_ratios is not None and self.split_by == "trajectory":
+            raise ValueError('partitioned runs have to split by file, trajectory indexes are local to a partition')
         
         # Create out_dir if it doesn't exist
-        if not os.path.exists(self.out_dir):
+        if not self.plan and not os.path.exists(self.out_dir):
             os.makedirs(self.out_dir)
         # If source directiory doesn't exist throw an error        
         if not os.path.exists(self.source_dir):
@@ -68,63 +152,23 @@ class TrajectoryProcessor:
         ch.setFormatter(formatter)
         self.log.addHandler(ch)
 
-        # create file handler which logs warnings errors and criticals
-        if os.path.exists(os.path.join(args.source_dir,'logs', 'error.log')):
-            os.remove(os.path.join(args.source_dir,'logs', 'error.log'))
-        else:
-            os.makedirs(os.path.join(args.source_dir,'logs'))
+        # create file handler which logs warnings errors and criticals,
+        # partitions running at the same time on one source directory log to their own files
+        log_name = 'error.log'
+        if getattr(args, 'partition', None) is not None:
+            k, n = parse_partition(args.partition)
+            log_name = 'error_' + str(k) + '_of_' + str(n) + '.log'
+        os.makedirs(os.path.join(args.source_dir, 'logs'), exist_ok=True)
 
-        fh = logging.FileHandler(os.path.join(args.source_dir,'logs', 'error.log'))
+        # Every run starts its log afresh
+        fh = logging.FileHandler(os.path.join(args.source_dir, 'logs', log_name), mode='w')
         fh.setLevel(logging.WARNING)
         fh.setFormatter(formatter)
         self.log.addHandler(fh)
 
     # Create pandas dataframe from the dictionary supplied from the read 
     def create_pandas_dataframes(self, dict_obj):
-        """Given a dictionary object dict_obj
-
-        If the argument `sound` isn't passed in, the default Animal
-        sound is used.
-
-        Parameters
-        ----------
-        dict_obj : dict ,
-            A dictionary with 3 keys: object_pose, tip_pose, ft_wrench
-            For each key, there is a collection of 4D vectors.
-
-        Raises
-        ------
-        ValueError
-            If no dict_obj is supplied to the function
-        
-        Returns
-        -------
-        obj_pd, tip_pd, ft_pd : pandas.dataframe ,
-            3 pandas DataFrames one for the object, one for tip and one for the force/torque sensor
-            Each dataframe has the time as its key/index
-    
-        """
-        if dict_obj is None:
-            raise ValueError("The file supplied is none!")
-    
-        try:
-            obj_pd = pd.DataFrame(dict_obj['object_pose'], columns=['time', 'x', 'y', 'orientation'])
-            tip_pd = pd.DataFrame(dict_obj['tip_pose']   , columns=['time', 'x', 'y', 'orientation'])
-            ft_pd  = pd.DataFrame(dict_obj['ft_wrench']  , columns=['time','force_x', 'force_y','torque'])
-
-            obj_pd["time"] = pd.to_datetime(obj_pd["time"], unit='s')
-            tip_pd["time"] = pd.to_datetime(tip_pd["time"], unit='s')
-            ft_pd["time"]  = pd.to_datetime(ft_pd["time"] , unit='s')
-
-            obj_pd = obj_pd.set_index('time')
-            tip_pd = tip_pd.set_index('time')
-            ft_pd  = ft_pd.set_index('time')
-            
-            return (obj_pd, tip_pd, ft_pd)
-
-        except Exception as e:
-            print("Oops!", e.__class__, "occurred.")
-            print()
+        return create_pandas_dataframes(dict_obj)
 
     # From a list of corner positions (states) create examples (state tuples)
     def _create_examples_and_write_file(self, cr_eg_index, traj, props):
@@ -136,70 +180,59 @@ class TrajectoryProcessor:
             acc = props['acc']
 
 
-        tr_ind = list(range(len(traj)))
-        
-        # Create example pair indeces
-        if self.number_of_steps == 2:
-            example_inds = list(zip(tr_ind, tr_ind[1:] + tr_ind[:1]))
-            example_inds = example_inds[:-(self.number_of_steps-1)]
-            
-        elif self.number_of_steps == 3:
-            example_inds = list(zip(tr_ind, tr_ind[1:] + tr_ind[:1], tr_ind[2:] + tr_ind[:2]))
-            example_inds = example_inds[:-(self.number_of_steps-1)]
-            
-        elif self.number_of_steps == 4:
-            example_inds = list(zip(tr_ind, tr_ind[1:] + tr_ind[:1], tr_ind[2:] + tr_ind[:2], tr_ind[3:] + tr_ind[:3]))
-            example_inds = example_inds[:-(self.number_of_steps-1)]
-            
-        else:
-            raise ValueError("number_of_steps has to be either 2, 3, or 4!!! Value you supplied was: "+ str(self.number_of_steps))
-        
-        
-        examples_collected = {} 
-        # Get the states at these indeces
-        for example_indexes in example_inds:
-            eg = traj[list(example_indexes)]
-            """
-            Each example has number_of_steps states,
-            each state is written to a file that contains 
-            states at the same timesteps compared to 
-            the first state in the example.
-            """
-            
-            for example, eg_ind in zip(eg, range(1,len(eg)+1)):
-                if eg_ind in examples_collected:
-                    current = examples_collected[eg_ind]
-                    examples_collected[eg_ind] = np.vstack((current,example))
-                else:
-                    examples_collected[eg_ind] = np.array(example)
+        # Every example is a window of number_of_steps consecutive states
+        windows = create_example_windows(traj, self.number_of_steps)
+        starts = np.arange(len(windows))
+        if self.contact_threshold is not None and len(windows) > 0:
+            # Drop the examples without contact before anything is formatted
+            records = as_records(traj, STATE_DTYPE)
+            in_contact = contact_distance(records["nodes"], records["tip"]) <= self.contact_threshold
+            keep = contact_windows(in_contact, self.number_of_steps, self.min_contact_steps)
+            self.dropped += len(windows) - int(keep.sum())
+            self.windows_seen += len(windows)
+            starts = starts[keep]
+            windows = windows[keep]
+        ids = np.arange(cr_eg_index, cr_eg_index + len(windows))
+        # The state table keeps every segment, even without windows, so the
+        # window index can be rebuilt for another number of steps later
+        if len(traj) == 0 or (len(windows) == 0 and self.layout != "table"):
+            return cr_eg_index
 
-        #print("---------------------")
-        #print(examples_collected)
-        #print("---------------------")
-        
-        cr_eg_index_alt = 0
-        for eg_ind in examples_collected:      
-            #Write the datasets
-            cr_eg_index_alt = cr_eg_index
-            with open(
-                    create_name_based_on_mixing(
-                        part_index = eg_ind,
-                        number_of_parts = self.number_of_steps,
-                        base_fileName = self.base_fileName,
-                        out_dir = self.out_dir,
-                        shape =  props['shape'],
-                        vel = vel,
-                        acc = acc),
-                    'a', newline='') as file:
-                    
-                csv_writer = csv.writer(file)
-                for example in examples_collected[eg_ind]:
-                    lin = np.concatenate(([cr_eg_index_alt], example))
-                    csv_writer.writerow(lin)
-                    # Update the index so that the each example in the dataset is uniquely indexed
-                    cr_eg_index_alt = cr_eg_index_alt + 1
-            
-        return cr_eg_index_alt
+        """
+        Each example has number_of_steps states,
+        each state is written to a file that contains 
+        states at the same timesteps compared to 
+        the first state in the example.
+        """
+        base_fileName = split_base_name(self.base_fileName, props.get('split'))
+        if self.layout == "table":
+            # Store the states once, the examples are windows into them
+            name = create_table_name_based_on_mixing(
+                base_fileName = base_fileName,
+                out_dir = self.out_dir,
+                shape = props['shape'],
+                vel = vel,
+                acc = acc)
+            if name not in self.writers:
+                self.writers[name] = StateTableWriter(name, self.number_of_steps, self.shuffle_buffer, self.seed)
+            self.writers[name].write(ids, traj, starts)
+            return cr_eg_index + len(windows)
+
+        names = [create_name_based_on_mixing(
+                    part_index = eg_ind,
+                    number_of_parts = self.number_of_steps,
+                    base_fileName = base_fileName,
+                    out_dir = self.out_dir,
+                    shape =  props['shape'],
+                    vel = vel,
+                    acc = acc,
+                    compress = self.compress)
+                 for eg_ind in range(1, self.number_of_steps+1)]
+        if names[0] not in self.writers:
+            self.writers[names[0]] = ExampleWriter(names, self.shuffle_buffer, self.seed, self.executor, self.formatter)
+        self.writers[names[0]].write(ids, windows, self.traj_index)
+
+        return cr_eg_index + len(windows)
     
     # From a list of lists of corner positions create examples 
     # (This additional loop is required to account for the removed datapoints,
@@ -249,60 +282,197 @@ class TrajectoryProcessor:
         
         return cr_eg_index
 
-    # Process the contents of a single file 
+    # Process the contents of a single file, returns its segments and their time range
     def _process_trajectory(self, trajectories_dict, props):
-        # Convert to dataframe
-        obj_pd, tip_pd, ft_pd = self.create_pandas_dataframes(trajectories_dict)
-        # Get rid of redundant entries and ensuring temporal ordering
-
-        # Treat orientation jumps, limit the range of orientation values
-
-        # Downsample
-        obj_pd_sampled, tip_pd_sampled, ft_pd_sampled = sample_dataset('10ms', obj_pd, tip_pd, ft_pd)
-        # Drop nan values
-        obj_pd_dropped, tip_pd_dropped, ft_pd_dropped = clear_dataset(obj_pd_sampled, tip_pd_sampled, ft_pd_sampled)
-        # Get Corner Positions
-        nodes_np = get_node_positions(props['shape'], obj_pd_dropped)
-        # Get state vectors
-        states_np = get_states(
-            nodes_np = nodes_np, 
-            object_pd = obj_pd_dropped, 
-            endeffector_pd = tip_pd_dropped, 
-            forceTorque_pd = ft_pd_dropped, 
-            velocity = props['vel'], 
-            acceleration = props['acc'],
-            traj_index = self.traj_index)
-
-        return states_np
+        anomalies = {}
+        time_range = {}
+        processed_nps = process_trajectory(trajectories_dict, props, self.traj_index, self.max_gap, anomalies, time_range)
+        self._log_anomalies(self.traj_index, anomalies)
+        return processed_nps, time_range
+
+    # Process the contents of a batch of files in one vectorized pass
+    def _process_batch(self, trajectories_dicts, props_list, traj_indexes):
+        anomalies_list = [{} for _ in trajectories_dicts]
+        time_ranges = [{} for _ in trajectories_dicts]
+        processed = process_trajectories_batch(trajectories_dicts, props_list, traj_indexes, self.max_gap,
+                                               anomalies_list, time_ranges)
+        for traj_index, anomalies in zip(traj_indexes, anomalies_list):
+            self._log_anomalies(traj_index, anomalies)
+        return processed, time_ranges
+
+    # Report what the sanitization had to fix in the source file
+    def _log_anomalies(self, traj_index, anomalies):
+        if any(anomalies.values()):
+            self.log.warning('Trajectory ' + str(traj_index) + ': ' +
+                             ', '.join(name + '=' + str(count) for name, count in anomalies.items()))
+
+    # The source files of this run, all of them or the ones of its partition
+    def _list_source_files(self):
+        files = [f for f in listdir(self.source_dir) if isfile(join(self.source_dir, f))]
+        if self.partition is not None:
+            k, n = self.partition
+            files = [f for f in files if assign_partition(f, n) == k]
+        return files
 
     # Process all the files in the folder
     def _process_trajectories(self):
         # Collect all the files in the directory.
-        files = [f for f in listdir(self.source_dir) if isfile(join(self.source_dir, f))]
+        files = self._list_source_files()
 
         # Get shape of processed objects
         shape = os.path.split(self.source_dir)[1]
 
 
-        _setup_output(
-            base_fileName=self.base_fileName,
-            number_of_parts=self.number_of_steps,
-            out_dir=self.out_dir,
-            shape = shape,
-            mixed_acc=self.mixed_acc,
-            mixed_vel=self.mixed_vel)
+        splits = [None]
+        if self.split_ratios is not None:
+            splits = SPLIT_NAMES[:len(self.split_ratios)]
+        output_files = []
+        for split in splits:
+            if self.layout == "table":
+                continue
+            output_files += _setup_output(
+                base_fileName=split_base_name(self.base_fileName, split),
+                number_of_parts=self.number_of_steps,
+                out_dir=self.out_dir,
+                shape = shape,
+                mixed_acc=self.mixed_acc,
+                mixed_vel=self.mixed_vel,
+                compress=self.compress)
 
         # Set index to 0
         cr_eg_index = 0
         self.traj_index = 0
-        for f in files:
-            # Read file
-            dict_obj = read_file(self.source_dir, f)
-            # Get properties:
+        self.writers = {}
+        summaries = []
+        dropped_total = 0
+        # Compression threads shared by all output files
+        self.executor = ThreadPoolExecutor(max_workers=self.compress_threads)
+        try:
+            batch_size = self.batch_files or 1
+            for batch_start in range(0, len(files), batch_size):
+                batch = files[batch_start:batch_start + batch_size]
+                # Read files
+                dict_objs = [read_file(self.source_dir, f, self.json_cache) for f in batch]
+                # Get properties:
+                properties_list = []
+                for i, f in enumerate(batch):
+                    properties = collect_trajectory_properties(f, shape)
+                    # Assign the trajectory to a split
+                    if self.split_ratios is not None:
+                        key = f if self.split_by == "file" else self.traj_index + i
+                        properties['split'] = assign_split(key, self.split_ratios, self.seed)
+                    properties_list.append(properties)
+                # Process files
+                if self.batch_files:
+                    traj_indexes = list(range(self.traj_index, self.traj_index + len(batch)))
+                    processed_list, time_ranges = self._process_batch(dict_objs, properties_list, traj_indexes)
+                else:
+                    processed_nps, time_range = self._process_trajectory(dict_objs[0], properties_list[0])
+                    processed_list, time_ranges = [processed_nps], [time_range]
+                del dict_objs
+                for f, properties, processed_nps, time_range in zip(batch, properties_list, processed_list, time_ranges):
+                    # Write example tuple following multi 
+                    self.dropped = 0
+                    self.windows_seen = 0
+                    first_id = cr_eg_index
+                    cr_eg_index = self._create_list_of_examples(processed_nps, cr_eg_index, properties)
+                    # One row of the trajectory summary, contact judged like the contact filter and the flagger
+                    summary = dict(properties, trajectory=self.traj_index, source=f, examples=cr_eg_index - first_id)
+                    threshold = self.contact_threshold if self.contact_threshold is not None else CONTACT_THRESHOLD
+                    summary.update(summarise_states(processed_nps, threshold, time_range))
+                    summaries.append(summary)
+                    if self.contact_threshold is not None:
+                        self.log.info('Trajectory ' + str(self.traj_index) + ' (' + str(f) + '): dropped ' +
+                                      str(self.dropped) + ' of ' + str(self.windows_seen) + ' examples without contact')
+                        dropped_total += self.dropped
+                    # Update traj index 
+                    self.traj_index += 1
+        except BaseException:
+            # Nothing of an interrupted run replaces the previous outputs
+            for writer in self.writers.values():
+                writer.abort()
+            self.executor.shutdown()
+            raise
+        if self.contact_threshold is not None:
+            self.log.info('Dropped ' + str(dropped_total) + ' examples without contact, kept ' + str(cr_eg_index))
+
+        # Write what is left in the shuffle buffers and the sidecars of every output file
+        written = []
+        for writer in self.writers.values():
+            writer.close()
+            written += getattr(writer, 'names', [])
+        empty = [name for name in output_files if name not in written]
+        if empty:
+            ExampleWriter(empty, self.shuffle_buffer, self.seed, formatter=self.formatter).close()
+        write_summary(self.out_dir, summaries)
+        self.executor.shutdown()
+
+    # Estimate the output of _process_trajectories from the file metadata only
+    def _plan_trajectories(self):
+        """
+        Dry run of _process_trajectories: only the shapes and time ranges of the
+        source files are read, the resampled states and the examples are estimated
+        from them. Prints the rows and sizes of every output file together with
+        the estimated runtime and the peak memory of a worker.
+
+        Returns
+        -------
+        outputs : dict ,
+            Output file name -> {'rows', 'bytes'} (bytes only for the table layout)
+        """
+        # The same files in the same order as _process_trajectories, so trajectories get the same indexes and splits
+        files = self._list_source_files()
+
+        # Get shape of processed objects
+        shape = os.path.split(self.source_dir)[1]
+
+        outputs = {}
+        seconds = 0.0
+        peak_memory = 0
+        for traj_index, f in enumerate(files):
+            metadata = CapacityPlanner.read_source_metadata(self.source_dir, f)
             properties = collect_trajectory_properties(f, shape)
-            # Process file
-            processed_nps = self._process_trajectory(dict_obj, properties)
-            # Write example tuple following multi 
-            cr_eg_index = self._create_list_of_examples(processed_nps, cr_eg_index, properties)
-            # Update traj index 
-            self.traj_index += 1 
\ No newline at end of file
+            if self.split_ratios is not None:
+                key = f if self.split_by == "file" else traj_index
+                properties['split'] = assign_split(key, self.split_ratios, self.seed)
+
+            states = CapacityPlanner.estimate_states(metadata)
+            examples = CapacityPlanner.estimate_examples(states, self.number_of_steps)
+
+            vel = None if self.mixed_vel else properties['vel']
+            acc = None if self.mixed_acc else properties['acc']
+            base_fileName = split_base_name(self.base_fileName, properties.get('split'))
+            if self.layout == "table":
+                names = [create_table_name_based_on_mixing(
+                    base_fileName = base_fileName,
+                    out_dir = self.out_dir,
+                    shape = shape,
+                    vel = vel,
+                    acc = acc)]
+            else:
+                names = [create_name_based_on_mixing(
+                            part_index = eg_ind,
+                            number_of_parts = self.number_of_steps,
+                            base_fileName = base_fileName,
+                            out_dir = self.out_dir,
+                            shape = shape,
+                            vel = vel,
+                            acc = acc,
+                            compress = self.compress)
+                         for eg_ind in range(1, self.number_of_steps+1)]
+            for name in names:
+                output = outputs.setdefault(name, {'rows': 0, 'bytes': 0})
+                output['rows'] += examples
+                if self.layout == "table":
+                    output['bytes'] += CapacityPlanner.estimate_table_bytes(states, examples)
+
+            seconds += CapacityPlanner.estimate_seconds(metadata, examples * len(names))
+            peak_memory = max(peak_memory, CapacityPlanner.estimate_memory(metadata, states, self.number_of_steps))
+
+        notes = []
+        if self.contact_threshold is not None:
+            notes.append('the contact filter is not estimated, rows and sizes are upper bounds')
+        digits = CapacityPlanner.written_digits(self.precision, self.dtype)
+        print(CapacityPlanner.format_plan(outputs, len(files), seconds, peak_memory, self.layout, self.compress,
+                                          digits, notes))
+        return outputs
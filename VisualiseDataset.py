@@ -1,23 +1,99 @@
 import argparse
 
-from VisualiseDatasetUtils.Visualiser import Visualiser
-
-def main(argv=None):
-
-    parser = argparse.ArgumentParser('process')
+# Heavy imports (numpy, pandas, matplotlib) are deferred to run, so parsing arguments stays fast
+def add_arguments(parser):
     parser.add_argument('-f', '--file', dest='source_file', type=str,
                         required=True,
                         help='The file holding the trajectory.')
     parser.add_argument('-i', '--trajectory-index', dest='traj_index', type=int,
-                        required=True,
                         help='The index of the trajectory we want to visualise')
+    parser.add_argument('--summary', dest='summary', type=str,
+                        help='The trajectory summary to query instead of giving -i, ' +
+                             '(default: trajectory_summary.tsv next to the file).')
+    parser.add_argument('--where', dest='where', type=str,
+                        help='Conditions on the summary columns, e.g. "contact_ratio<0.5 and vel>=50".')
+    parser.add_argument('--order-by', dest='order_by', type=str,
+                        help='Summary column to sort the matches by, e.g. rows. The first match is visualised.')
+    parser.add_argument('--descending', dest='descending', action='store_true',
+                        help='Sort the matches in descending order, e.g. --order-by rows --descending for the longest first.')
+    parser.add_argument('--target-fps', dest='target_fps', type=float,
+                        help='The playback rate the frame stride is chosen for, frames are decimated ' +
+                             'so trajectories play back in real time (default: 50).')
+    parser.add_argument('--max-frames', dest='max_frames', type=int,
+                        help='The maximum number of frames loaded from a trajectory.')
+    parser.add_argument('-b', '--batch-indices', dest='batch_indices', type=str,
+                        help='Render these trajectories to files instead of showing one, e.g. "0-99,120".')
+    parser.add_argument('-r', '--render-format', dest='render_format', type=str,
+                        help='The format of the batch rendered files: mp4, gif or png (default: mp4).')
+    parser.add_argument('-o', '--render-out-dir', dest='render_out_dir', type=str,
+                        help='Where to store the batch rendered files or the overview.')
+    parser.add_argument('-w', '--workers', dest='workers', type=int,
+                        help='The number of processes used for batch rendering (default: number of CPUs).')
+    parser.add_argument('--overview', dest='overview', action='store_true',
+                        help='Render dataset-wide density heatmaps of the whole file instead of one trajectory.')
+    parser.add_argument('--overview-bins', dest='overview_bins', type=int,
+                        help='The number of histogram bins along each axis of the overview (default: 100).')
+    parser.add_argument('--tip-extent', dest='tip_extent', type=float,
+                        help='Half width of the tip position heatmaps in metres (default: 0.15).')
+    parser.add_argument('--displacement-extent', dest='displacement_extent', type=float,
+                        help='Half width of the object displacement heatmap in metres (default: 0.3).')
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int,
+                        help='The number of rows read at once for the overview (default: 1000000).')
+    parser.add_argument('--strip-frames', dest='strip_frames', type=int,
+                        help='The number of frames in a png strip (default: 8).')
+
+# Pick the trajectory to show from the summary table
+def select_from_summary(args):
+    import os
+    from CommonUtils.TrajectorySummary import read_summary, query_summary, summary_file_name
+
+    summary = args.summary
+    if summary is None:
+        summary = summary_file_name(os.path.dirname(os.path.abspath(args.source_file)))
+    order_by = args.order_by
+    if order_by is not None and getattr(args, 'descending', False):
+        order_by = '-' + order_by
+    matches = query_summary(read_summary(summary), args.where, order_by)
+    if not matches:
+        raise ValueError('no trajectory in ' + str(summary) + ' matches: ' + str(args.where))
+    columns = ['trajectory', 'source', 'rows', 'duration', 'contact_ratio']
+    print(str(len(matches)) + ' matching trajectories:')
+    print('\t'.join(columns))
+    for row in matches[:10]:
+        print('\t'.join(str(row.get(column)) for column in columns))
+    return int(matches[0]['trajectory'])
+
+def run(args):
+    if args.traj_index is None and (getattr(args, 'summary', None) is not None
+                                    or getattr(args, 'where', None) is not None
+                                    or getattr(args, 'order_by', None) is not None):
+        args.traj_index = select_from_summary(args)
+
+    if args.overview:
+        from VisualiseDatasetUtils.DensityOverview import DensityOverview
+        pre = DensityOverview(args)
+        pre.visualise()
+    elif args.batch_indices is not None:
+        from VisualiseDatasetUtils.BatchRenderer import BatchRenderer
+        pre = BatchRenderer(args)
+        pre.render()
+    elif args.traj_index is not None:
+        from VisualiseDatasetUtils.Visualiser import Visualiser
+        pre = Visualiser(args)
+        pre.visualise()
+    else:
+        raise ValueError('one of -i/--trajectory-index, --where/--order-by, -b/--batch-indices or --overview is required')
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser('process')
+    add_arguments(parser)
 
     args = parser.parse_args(argv)
 
-    pre = Visualiser(args)
-    pre.visualise()
+    run(args)
     
 
 if __name__ == "__main__":
     main()
-                    
\ No newline at end of file
+                    
@@ -0,0 +1,182 @@
+import os
+import sys
+import logging
+import argparse
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+from CommonUtils.TrajectoryIndex import load_fragments, fragment_rows, read_header, read_fragmented_rows, parse_index_spec
+from VisualiseDatasetUtils.Visualiser import SAMPLE_RATE, choose_stride
+
+# Formats the batch renderer can write
+RENDER_FORMATS = ["mp4", "gif", "png"]
+
+
+# State of a worker process, set up once by _init_worker
+_worker = {}
+
+
+def _init_worker(shm_name, shape, dtype, source_file, header, out_dir, render_format, strip_frames):
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')
+    from VisualiseDatasetUtils.Visualiser import Visualiser
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _worker["shm"] = shm
+    _worker["data"] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    _worker["visualiser"] = Visualiser(argparse.Namespace(source_file=source_file, traj_index=None))
+    _worker["visualiser"].header = header
+    _worker["out_dir"] = out_dir
+    _worker["format"] = render_format
+    _worker["strip_frames"] = strip_frames
+
+
+# Render one trajectory, the rows are a slice of the shared array
+def _render_trajectory(task):
+    import matplotlib.pyplot as plt
+    from matplotlib import animation
+
+    traj_index, start, stop, stride = task
+    visualiser = _worker["visualiser"]
+    render_format = _worker["format"]
+
+    traj_dict = visualiser.create_dictionary(_worker["data"][start:stop])
+    traj_dict["step"] = np.arange(stop - start) * stride
+    # Every frame stands for stride samples, so the videos play back in real time
+    fps = SAMPLE_RATE / float(stride)
+    fig, anim, animate = visualiser.create_animation(traj_dict, interval=1000.0 / fps)
+    name = os.path.join(_worker["out_dir"], "trajectory_" + str(traj_index) + "." + render_format)
+
+    try:
+        if render_format == "mp4":
+            anim.save(name, writer=animation.FFMpegWriter(fps=fps))
+        elif render_format == "gif":
+            anim.save(name, writer=animation.PillowWriter(fps=fps))
+        else:
+            # A strip of evenly spaced frames side by side
+            frames = np.unique(np.linspace(0, stop - start - 1, _worker["strip_frames"]).astype(int))
+            images = []
+            for i in frames:
+                artists = animate(i)
+                fig.canvas.draw()
+                for artist in artists:
+                    artist.axes.draw_artist(artist)
+                images.append(np.asarray(fig.canvas.buffer_rgba()).copy())
+            plt.imsave(name, np.concatenate(images, axis=1))
+    finally:
+        plt.close(fig)
+
+    return name
+
+
+class BatchRenderer:
+
+    def __init__(self, args):
+        self.setup_logging()
+
+        # Set file holding the trajectories
+        self.file = args.source_file
+        # Set indices of the trajectories to render
+        self.indices = parse_index_spec(args.batch_indices)
+        # Set output directory
+        self.out_dir = 'rendered_trajectories'
+        if not args.render_out_dir == None:
+            self.out_dir = args.render_out_dir
+        # Set output format
+        self.render_format = "mp4"
+        if not args.render_format == None:
+            self.render_format = args.render_format
+        # Set number of worker processes
+        self.workers = os.cpu_count()
+        if not args.workers == None:
+            self.workers = args.workers
+        # Set number of frames in a png strip
+        self.strip_frames = 8
+        if not args.strip_frames == None:
+            self.strip_frames = args.strip_frames
+        # Set the playback rate the frame stride is chosen for
+        self.target_fps = 50
+        if not args.target_fps == None:
+            self.target_fps = args.target_fps
+        # Set the maximum number of frames rendered per trajectory
+        self.max_frames = args.max_frames
+
+        if self.render_format not in RENDER_FORMATS:
+            raise ValueError('render format has to be one of: ' + ", ".join(RENDER_FORMATS))
+        if not os.path.exists(self.file):
+            raise ValueError('source file does not exist: ' + self.file)
+        if self.render_format == "mp4":
+            from matplotlib import animation
+            if not animation.writers.is_available("ffmpeg"):
+                raise ValueError('mp4 rendering needs ffmpeg on the PATH, use --render-format gif or png instead')
+
+        # Create out_dir if it doesn't exist
+        if not os.path.exists(self.out_dir):
+            os.makedirs(self.out_dir)
+
+    def setup_logging(self):
+        self.log = logging.getLogger('batch_renderer')
+        self.log.setLevel(logging.DEBUG)
+        if not self.log.handlers:
+            ch = logging.StreamHandler(sys.stdout)
+            ch.setFormatter(logging.Formatter('%(asctime)s: [%(name)s] [%(levelname)s] %(message)s'))
+            self.log.addHandler(ch)
+
+    def read_trajectories(self):
+        """
+        Reads all requested trajectories in a single pass over the file.
+
+        Returns
+        -------
+        data : np.array ,
+            The rows of all trajectories, one after the other.
+        tasks : list ,
+            (trajectory index, first row, end row, stride) for every trajectory found in data.
+        """
+        index = load_fragments(self.file)
+        missing = [i for i in self.indices if i not in index]
+        if missing:
+            self.log.warning('Trajectories not in ' + str(self.file) + ': ' + str(missing))
+
+        found = [i for i in self.indices if i in index]
+        # One pass over the file, only the rendered frames of every trajectory are parsed
+        strides = [choose_stride(fragment_rows(index[i]), self.target_fps, self.max_frames) for i in found]
+        rows = []
+        tasks = []
+        for i, stride, traj_rows in zip(found, strides, read_fragmented_rows(self.file, [index[i] for i in found], strides)):
+            tasks.append((i, len(rows), len(rows) + len(traj_rows), stride))
+            rows += traj_rows
+
+        data = np.array([[float(ele) for ele in row] for row in rows])
+        return data, tasks
+
+    def render(self):
+        header = read_header(self.file)
+        data, tasks = self.read_trajectories()
+        if len(tasks) == 0:
+            return []
+
+        # Share the parsed rows with the workers instead of sending a copy with every task
+        shm = shared_memory.SharedMemory(create=True, size=data.nbytes)
+        try:
+            shared = np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)
+            shared[:] = data
+            del data
+
+            rendered = []
+            with ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    initializer=_init_worker,
+                    initargs=(shm.name, shared.shape, shared.dtype, self.file, header,
+                              self.out_dir, self.render_format, self.strip_frames)) as executor:
+                for task, name in zip(tasks, executor.map(_render_trajectory, tasks)):
+                    self.log.info('Rendered trajectory ' + str(task[0]) + ' to ' + name)
+                    rendered.append(name)
+            del shared
+        finally:
+            shm.close()
+            shm.unlink()
+
+        return rendered
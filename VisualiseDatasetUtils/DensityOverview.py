@@ -0,0 +1,160 @@
+import os
+import numpy as np
+import pandas as pd
+
+import matplotlib.pyplot as plt
+from matplotlib.colors import LogNorm
+
+from CommonUtils.TrajectoryIndex import read_header
+
+# Columns needed for the overview, in_contact is only present in flagged files
+OVERVIEW_COLUMNS = ["o_pos_x", "o_pos_y", "o_angle", "e_pos_x", "e_pos_y", "force_x", "force_y", "trajectory"]
+
+
+class DensityOverview:
+    """
+    Streams a whole processed or flagged file in chunks and accumulates
+    dataset-wide 2D histograms, so memory use only depends on the number
+    of bins and the chunk size, never on the number of rows.
+
+        - tip position in the object frame
+        - object displacement from the first pose of its trajectory
+        - mean force magnitude over the tip position in the object frame
+        - contact ratio over the tip position in the object frame (flagged files)
+    """
+
+    def __init__(self, args):
+        # Set file to summarise
+        self.file = args.source_file
+        # Set output directory, if omitted the overview is shown in a window
+        self.out_dir = args.render_out_dir
+        # Set number of bins along each axis
+        self.bins = 100
+        if not args.overview_bins == None:
+            self.bins = args.overview_bins
+        # Set half width of the tip position histograms (m)
+        self.tip_extent = 0.15
+        if not args.tip_extent == None:
+            self.tip_extent = args.tip_extent
+        # Set half width of the displacement histogram (m)
+        self.displacement_extent = 0.3
+        if not args.displacement_extent == None:
+            self.displacement_extent = args.displacement_extent
+        # Set number of rows read at once
+        self.chunk_size = 1000000
+        if not args.chunk_size == None:
+            self.chunk_size = args.chunk_size
+
+        if not os.path.exists(self.file):
+            raise ValueError('source file does not exist: ' + self.file)
+
+        self.tip_range = [[-self.tip_extent, self.tip_extent], [-self.tip_extent, self.tip_extent]]
+        self.displacement_range = [[-self.displacement_extent, self.displacement_extent],
+                                   [-self.displacement_extent, self.displacement_extent]]
+
+        self.tip_counts = np.zeros((self.bins, self.bins))
+        self.displacement_counts = np.zeros((self.bins, self.bins))
+        self.force_sums = np.zeros((self.bins, self.bins))
+        self.contact_sums = np.zeros((self.bins, self.bins))
+        self.has_contact = False
+
+        # First object pose of every trajectory seen so far, sorted by trajectory index
+        self.start_keys = np.array([], dtype=np.int64)
+        self.start_poses = np.zeros((0, 2))
+
+    # Remember the first pose of trajectories that start in this chunk
+    def update_start_poses(self, traj, obj_xy):
+        keys, first = np.unique(traj, return_index=True)
+        new = ~np.isin(keys, self.start_keys)
+        keys = np.concatenate((self.start_keys, keys[new]))
+        poses = np.concatenate((self.start_poses, obj_xy[first[new]]))
+        order = np.argsort(keys)
+        self.start_keys = keys[order]
+        self.start_poses = poses[order]
+
+    def accumulate(self, chunk):
+        obj_xy = chunk[["o_pos_x", "o_pos_y"]].to_numpy()
+        angle = chunk["o_angle"].to_numpy()
+        tip_xy = chunk[["e_pos_x", "e_pos_y"]].to_numpy()
+        force = chunk[["force_x", "force_y"]].to_numpy()
+        traj = chunk["trajectory"].to_numpy().astype(np.int64)
+
+        # Tip position rotated into the object frame
+        rel = tip_xy - obj_xy
+        cos = np.cos(angle)
+        sin = np.sin(angle)
+        rel_x = cos*rel[:, 0] + sin*rel[:, 1]
+        rel_y = -sin*rel[:, 0] + cos*rel[:, 1]
+
+        counts, _, _ = np.histogram2d(rel_x, rel_y, bins=self.bins, range=self.tip_range)
+        self.tip_counts += counts
+
+        force_magnitude = np.linalg.norm(force, axis=1)
+        sums, _, _ = np.histogram2d(rel_x, rel_y, bins=self.bins, range=self.tip_range, weights=force_magnitude)
+        self.force_sums += sums
+
+        if "in_contact" in chunk:
+            self.has_contact = True
+            contact = chunk["in_contact"].to_numpy().astype(float)
+            sums, _, _ = np.histogram2d(rel_x, rel_y, bins=self.bins, range=self.tip_range, weights=contact)
+            self.contact_sums += sums
+
+        # Object displacement relative to the first pose of its trajectory
+        self.update_start_poses(traj, obj_xy)
+        displacement = obj_xy - self.start_poses[np.searchsorted(self.start_keys, traj)]
+        counts, _, _ = np.histogram2d(displacement[:, 0], displacement[:, 1],
+                                      bins=self.bins, range=self.displacement_range)
+        self.displacement_counts += counts
+
+    def accumulate_file(self):
+        header = read_header(self.file)
+        columns = [col for col in OVERVIEW_COLUMNS + ["in_contact"] if col in header]
+        rows = 0
+        for chunk in pd.read_csv(self.file, usecols=columns, chunksize=self.chunk_size):
+            self.accumulate(chunk)
+            rows += len(chunk)
+        return rows
+
+    def render(self, rows):
+        fig, axs = plt.subplots(2, 2, figsize=(12, 11))
+        tip_extent = [-self.tip_extent, self.tip_extent, -self.tip_extent, self.tip_extent]
+        displacement_extent = [-self.displacement_extent, self.displacement_extent,
+                               -self.displacement_extent, self.displacement_extent]
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_force = self.force_sums / self.tip_counts
+            contact_ratio = self.contact_sums / self.tip_counts
+
+        panels = [
+            (axs[0, 0], self.tip_counts, tip_extent, "Tip position in object frame", "count", True),
+            (axs[0, 1], self.displacement_counts, displacement_extent, "Object displacement", "count", True),
+            (axs[1, 0], mean_force, tip_extent, "Mean force magnitude", "N", False),
+            (axs[1, 1], contact_ratio, tip_extent, "Contact ratio", "ratio", False)]
+
+        for ax, values, extent, title, unit, log in panels:
+            if title == "Contact ratio" and not self.has_contact:
+                ax.set_title(title + " (file is not flagged)")
+                ax.axis('off')
+                continue
+            norm = LogNorm(vmin=1) if log and np.any(values >= 1) else None
+            image = ax.imshow(values.T, origin='lower', extent=extent, norm=norm, interpolation='nearest')
+            fig.colorbar(image, ax=ax, label=unit)
+            ax.set_title(title)
+            ax.set_xlabel("x (m)")
+            ax.set_ylabel("y (m)")
+
+        fig.suptitle("Overview of " + os.path.basename(self.file) + " (" + str(rows) + " rows)")
+
+        if self.out_dir is None:
+            plt.show()
+        else:
+            if not os.path.exists(self.out_dir):
+                os.makedirs(self.out_dir)
+            name = os.path.join(self.out_dir, os.path.basename(self.file) + "_overview.png")
+            fig.savefig(name)
+            plt.close(fig)
+            return name
+
+    def visualise(self):
+        rows = self.accumulate_file()
+        return self.render(rows)
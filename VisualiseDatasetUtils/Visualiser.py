@@ -2,15 +2,29 @@ import os
 import sys
 import numpy as np
 import csv
-import pandas as pd
 
 import matplotlib.pyplot as plt
 from matplotlib import animation
 from matplotlib.patches import Polygon
+from matplotlib.widgets import Slider
 
 from os import listdir
 from os.path import isfile, join
 
+from CommonUtils.StateSchema import as_records, example_dtype
+from CommonUtils.TrajectoryIndex import load_fragments, fragment_rows, read_header, read_fragmented_rows
+
+# The processed datasets are resampled to 10ms
+SAMPLE_RATE = 100
+
+
+# Pick the frame stride that plays a trajectory back in real time at target_fps,
+# optionally also limiting the number of frames held in memory
+def choose_stride(rows, target_fps, max_frames=None):
+    stride = max(1, int(np.ceil(SAMPLE_RATE / float(target_fps))))
+    if max_frames is not None and max_frames > 0:
+        stride = max(stride, int(np.ceil(rows / float(max_frames))))
+    return stride
 
 class Visualiser:
     
@@ -19,22 +33,91 @@ class Visualiser:
         self.file = args.source_file
         # Set index of trajectory to visualise
         self.index = args.traj_index
+        # Set the playback rate the frame stride is chosen for
+        self.target_fps = 50
+        if not getattr(args, 'target_fps', None) == None:
+            self.target_fps = args.target_fps
+        # Set the maximum number of frames loaded from the trajectory
+        self.max_frames = None
+        if not getattr(args, 'max_frames', None) == None:
+            self.max_frames = args.max_frames
+        self.stride = 1
 
-    def visualise_trajectory(self, trajectory_dict):
-        fig, ax = plt.subplots()
+    def precompute_frames(self, trajectory_dict):
+        """
+        Computes everything the animation draws, for all frames at once,
+        so that the per-frame callback only has to hand arrays to the artists.
 
-        # ------------------Extraction------------------
-        # Extract object pose
-        obj_np = trajectory_dict["obj"]
-        # Extract tip pose
+        Parameters
+        ----------
+        trajectory_dict : dict ,
+            The dictionary created by create_dictionary.
+
+        Returns
+        -------
+        frames : dict ,
+            Per-frame geometry (corners, ordered polygon, tip, orientation and
+            force indicators) and the text labels, each indexed by frame.
+        """
         tip_np = trajectory_dict["tip"]
-        # Extract force/torque
         ft_np = trajectory_dict["ft"]
-        # Extract nodes
+        contact_np = trajectory_dict["contact"]
         nodes_np = trajectory_dict["nodes"][:, :-2]
         nodes_np = np.reshape(nodes_np, (len(nodes_np), 4, 2))
-        # Extract contact
-        contact_np = trajectory_dict["contact"]
+
+        frames = {}
+        frames["nodes"] = nodes_np
+        frames["polygon"] = self.order_vertices_batch(nodes_np)
+
+        # End-effector Tip: Position
+        tip_xy = tip_np[:, :2]
+        frames["tip"] = tip_xy
+
+        # End-effector Tip: Orientation
+        en = tip_xy + np.array([0, 0.05])
+        cos = np.cos(tip_np[:, 2])
+        sin = np.sin(tip_np[:, 2])
+        en = np.stack((cos*en[:, 0] - sin*en[:, 1], sin*en[:, 0] + cos*en[:, 1]), axis=1)
+        frames["orientation"] = np.stack((tip_xy, en), axis=2)
+
+        # Force Torque Sensor: Forces
+        ft = tip_xy + (ft_np[:, :2]/10.0)
+        frames["force"] = np.stack((tip_xy, ft), axis=2)
+
+        # Force Torque Sensor: Values
+        ft_i = np.around(ft_np, 4).astype(str)
+        labels = np.char.add('FT Sensor:\nForce x: ', ft_i[:, 0])
+        labels = np.char.add(labels, ' N\nForce y: ')
+        labels = np.char.add(labels, ft_i[:, 1])
+        labels = np.char.add(labels, ' N\nTorque: ')
+        labels = np.char.add(labels, ft_i[:, 2])
+        labels = np.char.add(labels, ' Nm\nIn contact: ')
+        labels = np.char.add(labels, np.where(contact_np.astype(bool), 'True', 'False'))
+        frames["values"] = labels
+        steps = trajectory_dict.get("step", np.arange(len(nodes_np)))
+        frames["title"] = np.char.add("Current timestep: ", np.asarray(steps).astype(str))
+
+        return frames
+
+    def create_animation(self, trajectory_dict, interval=20, scrub=False):
+        """
+        Builds the figure and the blitted animation of a trajectory without showing it.
+        With scrub the playback loops and a slider seeks to any frame,
+        the space bar pauses and resumes playback.
+
+        Returns
+        -------
+        fig, anim, animate :
+            The figure, the FuncAnimation and the per-frame callback,
+            which returns the artists it updated.
+        """
+        fig, ax = plt.subplots()
+
+        # ------------------Extraction------------------
+        # Extract object pose
+        obj_np = trajectory_dict["obj"]
+        # Precompute the geometry and labels of every frame
+        frames = self.precompute_frames(trajectory_dict)
 
         center_loc_x = np.mean(obj_np[:, 0])
         center_loc_y = np.mean(obj_np[:, 1])
@@ -47,16 +130,18 @@ class Visualiser:
 
 
         #Rectangle
-        rect = Polygon(self.order_vertices(nodes_np[0]), closed=False, animated=False, alpha=0.5, color='b')
+        rect = Polygon(frames["polygon"][0], closed=False, animated=True, alpha=0.5, color='b')
         ax.add_patch(rect)
 
-        nodes, = ax.plot([], [], 'bo',label="Corners")
-        end_effector, = ax.plot([], [], 'ro',label="End-Effector Tip")
-        tip_orientation_indicator, = ax.plot([], [], '--r',label="Tip Orientation")
-        force_indicator, = ax.plot([], [], ':g',label="Force")
+        nodes, = ax.plot([], [], 'bo',label="Corners", animated=True)
+        end_effector, = ax.plot([], [], 'ro',label="End-Effector Tip", animated=True)
+        tip_orientation_indicator, = ax.plot([], [], '--r',label="Tip Orientation", animated=True)
+        force_indicator, = ax.plot([], [], ':g',label="Force", animated=True)
         values_at_i = ax.text(center_loc_x - zoom_out*0.95, center_loc_y - zoom_out*0.7, "", size=10,
                 va="baseline", ha="left", multialignment="left",
-                bbox=dict(fc="none"))
+                bbox=dict(fc="none"), animated=True)
+        # The timestep is drawn inside the axes, blitting only restores the axes area
+        timestep = ax.text(0.5, 0.97, "", transform=ax.transAxes, ha="center", va="top", animated=True)
 
 
         fig.suptitle("Visualisation of trajectory")
@@ -64,57 +149,64 @@ class Visualiser:
         ax.set_ylabel("y (m)")
         ax.legend(loc=2)
 
+        artists = (nodes, end_effector, tip_orientation_indicator, force_indicator, values_at_i, rect, timestep)
+
         def init():
             nodes.set_data([], [])
             end_effector.set_data([], [])
             tip_orientation_indicator.set_data([], [])
             force_indicator.set_data([], [])
-            rect.set_xy(self.order_vertices(nodes_np[0]))
-            return (nodes, end_effector, tip_orientation_indicator, force_indicator, values_at_i, rect)
+            values_at_i.set_text("")
+            timestep.set_text("")
+            rect.set_xy(frames["polygon"][0])
+            return artists
 
         def animate(i):
-            nodes_pos_i = nodes_np[i]
-            tip_pos_i   = tip_np[i]
-            
-            # Corners
-            x_cors = nodes_pos_i[:, 0]
-            y_cors = nodes_pos_i[:, 1]    
-            nodes.set_data(x_cors, y_cors)
-            
-            # End-effector Tip: Position
-            x_tip = tip_pos_i[0]
-            y_tip = tip_pos_i[1]
-            end_effector.set_data(x_tip, y_tip)
-            
-            # End-effector Tip: Orientation
-            en = np.array([x_tip, y_tip]) + np.array([0, 0.05])
-            en = self.rotate_point(en, tip_pos_i[2])
-            tip_orientation_indicator.set_data([x_tip, en[0]], [y_tip,en[1]])
-            
-            # Force Torque Sensor:  Forces
-            ft = (np.array([x_tip, y_tip]) + (ft_np[i,:2]/10.0))
-            force_indicator.set_data([x_tip, ft[0]], [y_tip, ft[1]])
-            
-            # Force Torque Sensor: Values
-            ft_i = np.around(ft_np[i],4)
-            str_to_disp = "\n".join(['FT Sensor:',
-                                        'Force x: '+str(ft_i[0])+' N', 
-                                        'Force y: '+str(ft_i[1])+' N', 
-                                        'Torque: ' +str(ft_i[2])+' Nm',
-                                    'In contact: ' +str(bool(contact_np[i]))])
-            values_at_i.set_text(str_to_disp)
-            
-            # Rectangle
-            nods = np.copy(nodes_pos_i)
-            nods = self.order_vertices(nods)
-            rect.set_xy(nods)
-            
-            # Update title
-            ax.set_title("Current timestep: "+str(i))
-            
-            return (nodes, end_effector, tip_orientation_indicator, force_indicator, values_at_i, rect)
+            nodes.set_data(frames["nodes"][i, :, 0], frames["nodes"][i, :, 1])
+            end_effector.set_data(frames["tip"][i, 0:1], frames["tip"][i, 1:2])
+            tip_orientation_indicator.set_data(frames["orientation"][i, 0], frames["orientation"][i, 1])
+            force_indicator.set_data(frames["force"][i, 0], frames["force"][i, 1])
+            values_at_i.set_text(frames["values"][i])
+            rect.set_xy(frames["polygon"][i])
+            timestep.set_text(frames["title"][i])
+            return artists
+
+        if not scrub:
+            anim = animation.FuncAnimation(fig, animate, init_func=init, frames=obj_np.shape[0], interval=interval, blit=True)
+            return fig, anim, animate
+
+        # Seek/scrub control, the frame source follows the slider
+        fig.subplots_adjust(bottom=0.2)
+        slider_ax = fig.add_axes([0.15, 0.05, 0.7, 0.03])
+        slider = Slider(slider_ax, "Frame", 0, obj_np.shape[0]-1, valinit=0, valstep=1)
+        state = {"frame": 0, "paused": False}
+
+        def on_seek(value):
+            state["frame"] = int(value)
+
+        def on_key(event):
+            if event.key == ' ':
+                state["paused"] = not state["paused"]
+
+        def frame_source():
+            while True:
+                yield state["frame"]
+                if not state["paused"]:
+                    state["frame"] = (state["frame"] + 1) % obj_np.shape[0]
+
+        slider.on_changed(on_seek)
+        fig.canvas.mpl_connect('key_press_event', on_key)
+        anim = animation.FuncAnimation(fig, animate, init_func=init, frames=frame_source, interval=interval,
+                                       blit=True, cache_frame_data=False)
+        # Keep the slider alive as long as the animation
+        anim.slider = slider
 
-        anim = animation.FuncAnimation(fig, animate, init_func=init, frames=obj_np.shape[0], interval=20, blit=False)
+        return fig, anim, animate
+
+    def visualise_trajectory(self, trajectory_dict):
+        # Every frame stands for stride samples, so this plays back in real time
+        interval = 1000.0 * self.stride / SAMPLE_RATE
+        fig, anim, animate = self.create_animation(trajectory_dict, interval=interval, scrub=True)
         
         plt.show()
 
@@ -166,60 +258,56 @@ class Visualiser:
             print()
         return sorted_ray
 
+    # Vectorised order_vertices for a whole trajectory of polygons at once
+    def order_vertices_batch(self, rays):
+        if (not len(rays.shape) == 3) or (not rays.shape[2] == 2):
+            raise ValueError()
+        center = np.mean(rays, axis=1, keepdims=True)
+        vectors = rays - center
+        angles = np.arctan2(vectors[:, :, 1], vectors[:, :, 0])
+        arr1inds = angles.argsort(axis=1)[:, ::-1]
+        return np.take_along_axis(rays, arr1inds[:, :, np.newaxis], axis=1)
+
     def extract_trajectory(self, file, index):
-        
-        trajectory = np.array([])
-        in_contact = np.array([])
-        header = 0
-        found_index = False
-        #read csv, and split on "," the line
-        with open(file, mode ='r') as fl: 
-            # reading the CSV file 
-            csv_file = csv.reader(fl, delimiter=",") 
-            
-            # displaying the contents of the CSV file 
-            for row in csv_file:
-                try:
-                    traj_index = int(float(row[-2]))
-                    if traj_index == index:
-                        row[:-1] = [float(ele) for ele in row[:-1]]
-                        row[-1] = row[-1] in ["True"]
-                        found_index = True
-                        # Append to trajectory
-                        if len(trajectory) == 0:
-                            trajectory = np.array([row])
-                        else:
-                            trajectory = np.append(trajectory, [row], axis=0)
-
-                    if traj_index != index and found_index:
-                        break
-                except:
-                    header = np.array(row)
-                    #print(header)
-                
+        # Seek straight to the trajectory (all its fragments in shuffled files) using the sidecar index
+        fragments = load_fragments(file).get(index)
+        if fragments is None:
+            raise ValueError('Trajectory ' + str(index) + ' is not in: ' + str(file))
+        # Only load the frames that will be drawn
+        self.stride = choose_stride(fragment_rows(fragments), self.target_fps, self.max_frames)
+        rows = read_fragmented_rows(file, [fragments], self.stride)[0]
+        trajectory = np.array([[float(ele) for ele in row] for row in rows])
         return trajectory
 
     def create_dictionary(self, trajectory):
+        # Named zero-copy views of the columns
+        records = as_records(trajectory, example_dtype(self.header))
 
         traj_dict = {}
 
-        traj_dict["obj"] = trajectory[:, 11:14]
+        traj_dict["obj"] = records["obj"]
 
-        traj_dict["tip"] = trajectory[:, 14:17]
+        traj_dict["tip"] = records["tip"]
 
-        traj_dict["ft"] = trajectory[:, 17:20]
+        traj_dict["ft"] = records["ft"]
 
-        traj_dict["nodes"] = trajectory[:, 1:11]
+        traj_dict["nodes"] = records["nodes"]
         
-        traj_dict["contact"] = trajectory[:, -1]
+        if "in_contact" in records.dtype.names:
+            traj_dict["contact"] = records["in_contact"] > 0
+        else:
+            traj_dict["contact"] = np.zeros(len(records), dtype=bool)
         
         return traj_dict
 
     def visualise(self):
+        # Read header
+        self.header = read_header(self.file)
         # Extract trajectory
         trajectory = self.extract_trajectory(self.file, self.index)
         # Create dictionary
         traj_dict = self.create_dictionary(trajectory)
+        traj_dict["step"] = np.arange(len(trajectory)) * self.stride
         # Visualise
         animation = self.visualise_trajectory(traj_dict)
 
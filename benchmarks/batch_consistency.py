@@ -0,0 +1,126 @@
+import os
+import sys
+import argparse
+import time
+
+import numpy as np
+
+# Checks that the batched pipeline (process_trajectories_batch, used with
+# --batch-files) produces bit for bit the same segments as the per-file pandas
+# pipeline (process_trajectory), on generated recordings with the problems the
+# sanitization fixes: non-finite rows, unsorted and duplicate timestamps,
+# orientation wraps, gaps and streams that do not overlap at all. The batched
+# resampling reproduces the summation of pandas' resample().mean(), so run this
+# after upgrading pandas or numpy. Exits with 1 when the pipelines disagree.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from ProcessTrajectoriesUtils.DataManipulationTools import process_trajectory, process_trajectories_batch
+
+STREAMS = ['object_pose', 'tip_pose', 'ft_wrench']
+
+
+# One stream of (samples, 4) [time, x, y, z] rows with jittered sampling around rate Hz
+def generate_stream(rng, start, seconds, rate, orientation):
+    steps = rng.uniform(0.5, 1.5, int(seconds * rate)) / rate
+    times = start + np.cumsum(steps)
+    values = np.cumsum(rng.normal(0.0, 0.01, (len(times), 3)), axis=0)
+    if orientation:
+        # Orientations kept in (-pi, pi], a slow rotation wraps around
+        values[:, 2] = np.angle(np.exp(1j * (values[:, 2] + np.linspace(0.0, 4 * np.pi, len(times)))))
+    return np.column_stack((times, values))
+
+
+def generate_recording(rng, messy):
+    start = 1.49e9 + rng.uniform(0.0, 1e6)
+    seconds = rng.uniform(1.0, 4.0)
+    recording = {}
+    for stream in STREAMS:
+        rate = 1000.0 if stream == 'ft_wrench' else rng.uniform(150.0, 300.0)
+        recording[stream] = generate_stream(rng, start + rng.uniform(0.0, 0.05), seconds, rate, stream != 'ft_wrench')
+    if messy:
+        obj = recording['object_pose']
+        # A gap, non-finite values, swapped rows and repeated timestamps
+        gap = rng.integers(len(obj) // 4, len(obj) // 2)
+        obj = np.delete(obj, np.arange(gap, gap + 20), axis=0)
+        obj[rng.integers(0, len(obj), 3), 1] = np.nan
+        swap = rng.integers(1, len(obj) - 1, 5)
+        obj[[swap, swap + 1]] = obj[[swap + 1, swap]]
+        tip = recording['tip_pose']
+        repeat = rng.integers(1, len(tip), 5)
+        tip[repeat, 0] = tip[repeat - 1, 0]
+        recording['object_pose'] = obj
+    return recording
+
+
+def generate_recordings(rng, number):
+    recordings = [generate_recording(rng, messy=i % 2 == 1) for i in range(number)]
+    # Streams without any overlap leave a recording without states
+    recordings[-1]['tip_pose'][:, 0] += 1000.0
+    return recordings
+
+
+def compare(recordings, props_list, max_gap):
+    mismatches = []
+    per_file = []
+    start = time.perf_counter()
+    for traj_index, (recording, props) in enumerate(zip(recordings, props_list)):
+        anomalies = {}
+        time_range = {}
+        segments = process_trajectory(recording, props, traj_index, max_gap, anomalies, time_range)
+        per_file.append((segments, anomalies, time_range))
+    per_file_seconds = time.perf_counter() - start
+
+    anomalies_list = [{} for _ in recordings]
+    time_ranges = [{} for _ in recordings]
+    start = time.perf_counter()
+    batched = process_trajectories_batch(recordings, props_list, list(range(len(recordings))), max_gap,
+                                         anomalies_list, time_ranges)
+    batch_seconds = time.perf_counter() - start
+
+    for traj_index, (segments, anomalies, time_range) in enumerate(per_file):
+        batch_segments = batched[traj_index]
+        if len(segments) != len(batch_segments):
+            mismatches.append((traj_index, str(len(segments)) + ' segments, batched ' + str(len(batch_segments))))
+            continue
+        for number, (segment, batch_segment) in enumerate(zip(segments, batch_segments)):
+            if segment.shape != batch_segment.shape or segment.tobytes() != batch_segment.tobytes():
+                difference = np.max(np.abs(segment - batch_segment)) if segment.shape == batch_segment.shape else None
+                mismatches.append((traj_index, 'segment ' + str(number) + ' differs, largest difference: ' + str(difference)))
+        if anomalies != anomalies_list[traj_index]:
+            mismatches.append((traj_index, 'anomalies ' + str(anomalies) + ', batched ' + str(anomalies_list[traj_index])))
+        if time_range != time_ranges[traj_index]:
+            mismatches.append((traj_index, 'time range ' + str(time_range) + ', batched ' + str(time_ranges[traj_index])))
+    return mismatches, per_file_seconds, batch_seconds
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser('batch_consistency')
+    parser.add_argument('-n', '--recordings', dest='recordings', type=int, default=8,
+                        help='The number of generated recordings, processed as one batch.')
+    parser.add_argument('--seed', dest='seed', type=int, default=0,
+                        help='Seed of the generated recordings.')
+    parser.add_argument('--max-gap', dest='max_gap', type=float, default=0.01,
+                        help='The largest time difference within a segment, as in ProcessTrajectories.py.')
+
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(args.seed)
+    recordings = generate_recordings(rng, max(args.recordings, 2))
+    props_list = [{'shape': 'rect1', 'vel': 10 * (i % 4 + 1), 'acc': 0} for i in range(len(recordings))]
+
+    mismatches, per_file_seconds, batch_seconds = compare(recordings, props_list, args.max_gap)
+    print('{:<12} {:>12} {:>12}'.format('recordings', 'per file (s)', 'batched (s)'))
+    print('{:<12} {:>12.3f} {:>12.3f}'.format(len(recordings), per_file_seconds, batch_seconds))
+    for traj_index, message in mismatches:
+        print('recording ' + str(traj_index) + ': ' + message)
+    if mismatches:
+        print('The batched pipeline does not match the per-file pipeline.')
+        sys.exit(1)
+    print('The batched pipeline matches the per-file pipeline.')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+import os
+import sys
+import argparse
+import subprocess
+import time
+
+import numpy as np
+
+# Measures how long the command line tools take to start, by timing
+# `mitpush.py <command> --help` in fresh interpreters. The lazy entry point is
+# compared with the same command after eagerly importing the implementation
+# modules, which is what every launch used to pay for.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COMMANDS = {
+    'process': 'ProcessTrajectoriesUtils.TrajectoryProcessor',
+    'flag': 'FlagNonContactUtils.DistanceFilter',
+    'visualise': 'VisualiseDatasetUtils.Visualiser'}
+
+
+def time_command(cmd, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(cmd, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return np.median(times) * 1000.0
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser('startup_time')
+    parser.add_argument('-r', '--repeats', dest='repeats', type=int, default=10,
+                        help='The number of launches timed per command.')
+
+    args = parser.parse_args(argv)
+
+    print('{:<10} {:>12} {:>12} {:>8}'.format('command', 'eager (ms)', 'lazy (ms)', 'speedup'))
+    for command, module in COMMANDS.items():
+        lazy = [sys.executable, 'mitpush.py', command, '--help']
+        eager = [sys.executable, '-c',
+                 'import sys, ' + module + ', mitpush; sys.argv = ["mitpush"]; mitpush.main(["' + command + '", "--help"])']
+        lazy_ms = time_command(lazy, args.repeats)
+        eager_ms = time_command(eager, args.repeats)
+        print('{:<10} {:>12.1f} {:>12.1f} {:>7.1f}x'.format(command, eager_ms, lazy_ms, eager_ms / lazy_ms))
+
+
+if __name__ == "__main__":
+    main()
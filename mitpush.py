@@ -0,0 +1,39 @@
+import argparse
+
+import ProcessTrajectories
+import FlagNonContactStates
+import VisualiseDataset
+import MergePartitions
+import FetchExamples
+
+# Single entry point for all tools:
+#     python mitpush.py process   ...  (ProcessTrajectories.py)
+#     python mitpush.py flag      ...  (FlagNonContactStates.py)
+#     python mitpush.py visualise ...  (VisualiseDataset.py)
+#     python mitpush.py merge     ...  (MergePartitions.py)
+#     python mitpush.py fetch     ...  (FetchExamples.py)
+# Only argparse is imported up front, each subcommand imports its
+# numpy/pandas/h5py/matplotlib stack when it runs.
+COMMANDS = [
+    ('process', ProcessTrajectories, 'Convert h5/json recordings into state tuple files.'),
+    ('flag', FlagNonContactStates, 'Flag the states where the end effector is in contact.'),
+    ('visualise', VisualiseDataset, 'Visualise trajectories of a state file.'),
+    ('merge', MergePartitions, 'Merge the outputs of partitioned runs, renumbering ids and trajectories.'),
+    ('fetch', FetchExamples, 'Fetch n-step examples by id from their part files.')]
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser('mitpush')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for name, module, help_text in COMMANDS:
+        subparser = subparsers.add_parser(name, help=help_text)
+        module.add_arguments(subparser)
+        subparser.set_defaults(run=module.run)
+
+    args = parser.parse_args(argv)
+
+    args.run(args)
+    
+
+if __name__ == "__main__":
+    main()